@@ -2,10 +2,21 @@
 This config file contains the following information:
 	- path to the excel file containing "activities" and "lcia methods"
 	- path to the ecoinvent db
+	- path to the cache of the parsed workbooks
+	- options of the LCA calculation
+	- path to the store of the LCA results (reused by later runs)
 """
 
 LCA_MODELS = r"C:\Users\qtu2020\Documents\SE-EmbodiedImpacts\bw2_calc_input.xlsx"
 EI_DB_NAME = "ei35_cutoff" #"some random db"
 EI_DB_PATH = r"C:\Users\qtu2020\Desktop\ecoinvent 3.5_cutoff_ecoSpold02\datasets"
 EI_OVERVIEW_FILE_PATH = r"C:\Users\qtu2020\Documents\SE-EmbodiedImpacts\activity_overview_3.6_undefined_public_1.xlsx"
-OUTPUT_PATH = r"C:\Users\qtu2020\Documents\SE-EmbodiedImpacts\output"
\ No newline at end of file
+OUTPUT_PATH = r"C:\Users\qtu2020\Documents\SE-EmbodiedImpacts\output"
+CACHE_PATH = r"C:\Users\qtu2020\Documents\SE-EmbodiedImpacts\cache"
+ACT_MATCH_MODE = "substring" # how the activities in the "activities" sheet are matched: "substring" or "exact"
+CALC_MODE = "auto" # how the LCIA results are calculated: "auto", "adjoint", "batched", "stacked" or "per_activity"
+BLOCK_SIZE = 256 # number of activities solved together in "batched" mode, larger blocks are faster but use more memory
+N_WORKERS = 1 # number of worker processes for the LCA calculation, e.g., the number of cores of the machine
+RESULT_CACHE_PATH = r"C:\Users\qtu2020\Documents\SE-EmbodiedImpacts\cache\lca_results.sqlite" # None: do not reuse results of previous runs
+STREAM_FORMAT = "csv" # write the results block by block as they are calculated: "csv", "npy" (memory-mapped), None: keep them in memory
+IMPORT_N_WORKERS = 1 # number of worker processes parsing the ecoinvent datasets at the import, 1: no multiprocessing
@@ -22,7 +22,14 @@ import pandas as pd
 import numpy as np
 import sys
 import os
+import time
 import SE_config #this is a file that needs to be prepared separately
+from utilities.lookup_helper import ActOverviewIndex, ActivityIndex, MethodResolver
+from utilities.lca_engine_helper import LCASystem, stack_characterization, score_parallel, db_fingerprint
+from utilities.result_cache_helper import ResultCache
+from utilities.result_writer_helper import StreamingResultWriter
+from utilities.import_helper import ParallelEcospold2Extractor
+from utilities.xlsx_cache_helper import read_excel_cached
 from collections import defaultdict
 
 
@@ -48,89 +55,192 @@ db_supported = ["ei35_cutoff","ei36_cutoff","ei371_cutoff"]
 define functions
 ================
 """
-def search_ei_act(ei_act_overview_df: pd.DataFrame, keywords_list: list) -> pd.DataFrame:
+def search_ei_act(ei_act_overview_df: pd.DataFrame, keywords_list: list, act_overview_index=None) -> pd.DataFrame:
 	"""
 	this function uses keywords to identify the activities (unit processes) of interest from a given ecoinvent database
 	Input params:
 		- ei_act_overview_df: a dataframe containing the overview of all activities in a given ecoinvent database
 		- keywords_list: a list of [(activity, location)] of interest
+		- act_overview_index: (optional) a prebuilt ActOverviewIndex of ei_act_overview_df, built here if not provided
 	Output params:
-		- act_identified_df: a dataframe containing the activity names and locations
+		- act_identified_df: a dataframe containing the unique activity names and locations
 	"""
 
-	# prepare a dict to store the activities identified
-	act_identified_dict = {'name': [], 'location': []} # [CAUTION] the keys (i.e., 'name', 'location') should be exactly the same as the headers in bw2_cal_input.xlsx
+	# index the unique (activity name, geography) pairs from 'activity_overview_3.6_undefined_public_1.xlsx'
+	# [CAUTION] the overview includes the same activity for each 'product name' (i.e., multiple co-products of the same activity),
+	#   the index only keeps one entry per (activity name, geography) -> no duplicated LCA results downstream
+	if act_overview_index is None:
+		act_overview_index = ActOverviewIndex(ei_act_overview_df)
 
-	# obtained a list of (activity name, geography) from 'activity_overview_3.6_undefined_public_1.xlsx'
-	avail_act_loc_list = list(zip(ei_act_overview_df['activity name'].tolist(), ei_act_overview_df['geography'].tolist()))
-	#print(f"avail activities and geography list: {avail_act_loc_list}")
+	# kw of activitiy in activity name of ecoinvent AND locations are the same (or location is 'unspecified')
+	act_loc_identified = act_overview_index.search(keywords_list)
 
-	# loop over the list of (activity, location) of interest
-	for act_loc_tuple in keywords_list:
-		for avail_act_loc_tuple in avail_act_loc_list:
-			# kw of activitiy in activity name of ecoinvent AND locations are the same
-			# [CAUTION] this may lead to multiple duplicated entries, as'activity_overview_3.6_undefined_public_1.xlsx' include the same activity for 
-			#   each 'product name', if there are multiple products coming out of the same activity -> there will be mulitiple duplicated LCA results ->
-			#   longer runtime and duplicate rows in the output file
-			if (act_loc_tuple[0].lower() in avail_act_loc_tuple[0].lower()) and (act_loc_tuple[1].lower() == avail_act_loc_tuple[1].lower() or act_loc_tuple [1].lower() == 'unspecified'):
-				act_identified_dict['name'].append(avail_act_loc_tuple[0])
-				act_identified_dict['location'].append(avail_act_loc_tuple[1])
-
-	act_identified_df = pd.DataFrame(act_identified_dict)
+	# [CAUTION] the keys (i.e., 'name', 'location') should be exactly the same as the headers in bw2_cal_input.xlsx
+	act_identified_df = pd.DataFrame(act_loc_identified, columns=['name', 'location'])
 
 	return act_identified_df
 
 
-def calc_lca(act_sheet: pd.DataFrame, lcia_method_sheet: pd.DataFrame, imported_db) -> pd.DataFrame:
+def calc_lca(act_sheet: pd.DataFrame, lcia_method_sheet: pd.DataFrame, imported_db, match_mode='substring', mode='auto', block_size=256, n_workers=1, result_cache_path=None,
+			stream_output_stem=None, stream_format='csv') -> pd.DataFrame:
+	"""
+	this function calculates the LCIA results of the activities of interest for the impact assessment methods of interest
+	Input params:
+		- act_sheet: a dataframe of the activities of interest, with 'name', 'location' (and optionally 'reference product') headers
+		- lcia_method_sheet: a dataframe of the impact assessment methods of interest
+		- imported_db: the (ecoinvent) database to search the activities in
+		- match_mode: 'substring' (name and location are part of those of the activity) or 'exact'
+		- mode: how the LCIA results are calculated
+			* 'stacked': all methods are scored from the supply vector of the activity with one sparse product
+			* 'batched': same as 'stacked', but the activities are solved together in blocks of block_size
+			* 'adjoint': the scores of all activities of the db are obtained with one transposed solve per method
+			* 'auto': 'adjoint' if there are more activities than methods, 'batched' otherwise
+			* 'per_activity': one inventory matrix per activity, characterized by each method separately
+		- block_size: number of activities solved together in 'batched' mode, number of methods solved together in 'adjoint'
+			mode (memory/throughput knob)
+		- n_workers: number of worker processes, >1 shards the activities across a process pool ('stacked'/'batched' modes,
+			solved in batches by each worker); the results of a failed shard are NaN, the other shards are kept
+		- result_cache_path: (optional) path to the SQLite store of the results, only the (activity, method) pairs missing
+			from it are calculated ('auto'/'adjoint'/'batched'/'stacked' modes); the new results are stored block by block
+		- stream_output_stem: (optional) path (without extension) to stream the results to, block by block, instead of
+			keeping them in memory, see StreamingResultWriter; the function then returns None
+		- stream_format: 'csv' ('<stream_output_stem>.csv') or 'npy' (memory-mapped .npy with sidecar index files)
+	Output params:
+		- lcia_results_df: a dataframe containing the activity attributes and the LCIA results (None if streamed)
+	"""
 	# inspired by https://github.com/brightway-lca/brightway2/blob/master/notebooks/Meta-analysis%20of%20LCIA%20methods.ipynb
 
-	# prepare a list of (act_name, loc)
+	# prepare a list of (act_name, loc) or (act_name, loc, reference product)
 	act_loc_dict = act_sheet.to_dict('list')
 	act_loc_tuples = list(zip(act_loc_dict['name'],act_loc_dict['location']))
+	if 'reference product' in act_loc_dict:
+		act_loc_tuples = [act_loc + (ref_prod,) if isinstance(ref_prod, str) else act_loc
+							for act_loc, ref_prod in zip(act_loc_tuples, act_loc_dict['reference product'])]
 	#print(act_loc_tuples)
 
-	# prepare a list of activities retrived from db
-	act_list = [act for act in imported_db for act_loc_tuple in act_loc_tuples if act_loc_tuple[0] in act['name'] and act_loc_tuple [1] in act['location']]
+	# prepare a list of activities retrived from db, using the (name, location) index of the db (built once and stored with the project)
+	act_index = ActivityIndex(imported_db.name)
+	act_positions = act_index.resolve(act_loc_tuples, mode=match_mode)
+	act_list = [get_activity(key) for key in act_index.get_keys(act_positions)]
 	#print(f"activities identified from imported db: {act_list}")
 
-	# prepare a list of impact assessment methods
-	lcia_methods = []
-	for bw_method in methods: # e.g., ('ReCiPe Endpoint (E,A) w/o LT','ecosystem quality w/o LT','freshwater eutrophication w/o LT')
-		for idx_lvl_0,lvl_0_name in enumerate(lcia_method_sheet['LCIA_method_lvl_0']):
-			if lvl_0_name in bw_method[0]:
-				if lcia_method_sheet['LCIA_method_lvl_1'].iloc[idx_lvl_0] in bw_method[1]:
-					if lcia_method_sheet['LCIA_method_lvl_2'].iloc[idx_lvl_0] in bw_method[2]:
-						lcia_methods.append(bw_method)
-					else: continue
-				else: continue  
-			else: continue
+	# prepare a list of impact assessment methods, e.g., ('ReCiPe Endpoint (E,A) w/o LT','ecosystem quality w/o LT','freshwater eutrophication w/o LT')
+	lcia_methods, unmatched_rows_df = MethodResolver().resolve(lcia_method_sheet)
 	
 	print(f"impact assessment methods identified: {lcia_methods}")
+	if len(unmatched_rows_df) > 0:
+		print(f"[caution] the following rows of the LCIA_methods sheet do not match any installed method:\n{unmatched_rows_df}", "\n")
+
+	# create a numpy array to store results (memory-mapped on disk, if the results are streamed)
+	if stream_output_stem is not None:
+		writer = StreamingResultWriter(stream_output_stem, act_index.get_records(act_positions), lcia_methods, fmt=stream_format)
+		lcia_results = writer.results
+	else:
+		writer = None
+		lcia_results = np.zeros((len(act_list),len(lcia_methods)))
+
+	if mode in ['auto', 'stacked', 'batched', 'adjoint']:
+		# prepare (activity key, production amount) of each activity of interest
+		demands = [(act.key, next(iter(act.production()))['amount']) for act in act_list] # https://stackoverflow.com/questions/68133565/negative-production-for-end-of-life-treatment-process
+
+		# look up the (activity, method) pairs already calculated in previous (or interrupted) runs
+		# [note] the missing pairs are tracked block by block, i.e., the result grid is never scanned as a whole
+		if result_cache_path is not None:
+			result_cache = ResultCache(result_cache_path)
+			fingerprint = db_fingerprint()
+			rows_missing, cols_missing = np.zeros(len(demands), dtype=bool), np.zeros(len(lcia_methods), dtype=bool)
+			for start in range(0, len(demands), block_size):
+				block_results = result_cache.lookup(fingerprint, demands[start:start + block_size], lcia_methods)
+				lcia_results[start:start + block_size, :] = block_results
+				block_missing = np.isnan(block_results)
+				rows_missing[start:start + block_size] = block_missing.any(axis=1)
+				cols_missing |= block_missing.any(axis=0)
+			rows_todo, cols_todo = np.flatnonzero(rows_missing), np.flatnonzero(cols_missing)
+		else:
+			lcia_results[:] = np.nan
+			rows_todo, cols_todo = np.arange(len(demands)), np.arange(len(lcia_methods))
+
+		# only calculate the activities and methods with missing results
+		demands_todo = [demands[row] for row in rows_todo]
+		methods_todo = [lcia_methods[col] for col in cols_todo]
+		print(f"{len(demands) - len(rows_todo)} of {len(demands)} activities are fully cached, calculating the rest")
+
+		def on_block(start, end, block_results, method_start=0, method_end=None):
+			# store the results of a block of activities (and methods) as soon as it is calculated
+			block_cols = cols_todo[method_start:method_end]
+			lcia_results[np.ix_(rows_todo[start:end], block_cols)] = block_results
+			if result_cache_path is not None:
+				result_cache.store(fingerprint, demands_todo[start:end], [lcia_methods[col] for col in block_cols], block_results)
+			if writer is not None:
+				writer.flush()
+
+		# [note] the adjoint mode costs one solve per method (instead of one per activity), it is only worth it when
+		# 		there are more activities than methods -> otherwise, fall back to the batched per-activity solves
+		if mode == 'auto':
+			mode = 'adjoint' if len(methods_todo) < len(demands_todo) else 'batched'
+			print(f"calculation mode selected: {mode}")
+
+		if len(demands_todo) == 0:
+			pass
+		elif n_workers > 1 and mode != 'adjoint':
+			# shard the activities across a process pool, each worker factorizes the technosphere matrix once
+			_, failed_shards = score_parallel(projects.current, demands_todo, methods_todo, n_workers, block_size=block_size, on_shard=on_block)
+			if failed_shards:
+				print(f"[caution] the results of {sum(end - start for start, end in failed_shards)} activities are missing (NaN) due to failed shards", "\n")
+		else:
+			# load the matrices (from the cache of the project, if up-to-date) and factorize the technosphere matrix (A=LU) once
+			lca_system = LCASystem.load_or_build(demands_todo[0])
+
+			# stack the characterization factors of all methods into one (methods x biosphere flows) matrix
+			char_stack = stack_characterization(methods_todo, lca_system.biosphere_dict)
+
+			if mode == 'stacked':
+				# loop over all activities of interest, all scores of an activity come from its supply vector
+				for idx_1, demand in enumerate(demands_todo):
+					on_block(idx_1, idx_1 + 1, lca_system.score_stacked(dict([demand]), char_stack)[np.newaxis, :])
+			elif mode == 'batched':
+				# solve the activities of interest block by block (one demand column per activity)
+				lca_system.score_batched(demands_todo, char_stack, block_size=block_size, on_block=on_block)
+			else:
+				# score every activity of the db (one transposed solve per method, block_size methods at a time),
+				# then slice the activities of interest
+				lca_system.score_adjoint(demands_todo, char_stack, block_size=block_size, on_block=on_block)
+
+		if result_cache_path is not None:
+			result_cache.close()
+
+	elif mode == 'per_activity':
+		# creat the technosphere matrix for faster calculation
+		tmp_amt = next(iter(act_list[0].production()))['amount'] # https://stackoverflow.com/questions/68133565/negative-production-for-end-of-life-treatment-process
+		lca = LCA({act_list[0]: tmp_amt}, method=lcia_methods[0])
+		lca.lci()
+		lca.decompose_technosphere() # A=LU speeds up the calculation, but when new technosphere matrix A is created, need to re-decompose
+		lca.lcia() # load the method data
+
+		# get the characterization factor matrix
+		char_matrices = []
+		for method in lcia_methods:
+			lca.switch_method(method)
+			char_matrices.append(lca.characterization_matrix.copy())
+
+		# loop over all activities of interest
+		for idx_1, act in enumerate(act_list):
+			# update tmp_amt
+			tmp_amt = next(iter(act.production()))['amount']
+			lca.redo_lci({act:tmp_amt})
+			#print(act)
+			for idx_2, matrix in enumerate(char_matrices):
+				lcia_results[idx_1,idx_2] = (matrix * lca.inventory).sum()
 
-	# create a numpy array to store results
-	lcia_results = np.zeros((len(act_list),len(lcia_methods)))
-
-	# creat the technosphere matrix for faster calculation
-	tmp_amt = next(iter(act_list[0].production()))['amount'] # https://stackoverflow.com/questions/68133565/negative-production-for-end-of-life-treatment-process
-	lca = LCA({act_list[0]: tmp_amt}, method=lcia_methods[0])
-	lca.lci()
-	lca.decompose_technosphere() # A=LU speeds up the calculation, but when new technosphere matrix A is created, need to re-decompose
-	lca.lcia() # load the method data
-
-	# get the characterization factor matrix
-	char_matrices = []
-	for method in lcia_methods:
-		lca.switch_method(method)
-		char_matrices.append(lca.characterization_matrix.copy())
-
-	# loop over all activities of interest
-	for idx_1, act in enumerate(act_list):
-		# update tmp_amt
-		tmp_amt = next(iter(act.production()))['amount']
-		lca.redo_lci({act:tmp_amt})
-		#print(act)
-		for idx_2, matrix in enumerate(char_matrices):
-			lcia_results[idx_1,idx_2] = (matrix * lca.inventory).sum()
+	else:
+		raise ValueError(f"unknown calculation mode '{mode}', use 'auto', 'adjoint', 'batched', 'stacked' or 'per_activity'")
+
+	# the streamed results are already on disk
+	if writer is not None:
+		# drop the reference to the memory-mapped results (shared with on_block), so that close() can unmap and remove the .npy
+		lcia_results = None
+		print(f"The LCA results have been exported to {writer.close()}")
+		return None
 
 	# create a df to store the LCA results for export
 	lcia_results_df = pd.DataFrame(lcia_results, columns=lcia_methods)
@@ -164,11 +274,13 @@ if __name__ == '__main__':
 	args = vars(ap.parse_args())
 
 	# load information of interest
-	lcia_method_sheet = pd.read_excel(SE_config.LCA_MODELS,sheet_name="LCIA_methods")
-	act_sheet = pd.read_excel(SE_config.LCA_MODELS,sheet_name="activities")
+	# [note] the workbooks are parsed once and cached in a binary form (rebuilt automatically when the workbook changes)
+	lca_models_dict = read_excel_cached(SE_config.LCA_MODELS, ["LCIA_methods", "activities"], SE_config.CACHE_PATH)
+	lcia_method_sheet = lca_models_dict["LCIA_methods"]
+	act_sheet = lca_models_dict["activities"]
 	ei_db_name = SE_config.EI_DB_NAME
 	ei_db_path = SE_config.EI_DB_PATH
-	ei_act_overview_df = pd.read_excel(SE_config.EI_OVERVIEW_FILE_PATH,sheet_name="activity overview")
+	ei_act_overview_df = read_excel_cached(SE_config.EI_OVERVIEW_FILE_PATH, ["activity overview"], SE_config.CACHE_PATH)["activity overview"]
 	output_path = SE_config.OUTPUT_PATH
 
 
@@ -194,10 +306,16 @@ if __name__ == '__main__':
 		if ei_db_name in databases:
 			print(f"[caution] {ei_db_name} alraedy imported!!", "\n")
 		else:
-			db = SingleOutputEcospold2Importer(ei_db_path,ei_db_name, use_mp=False)
+			stage_start = time.perf_counter()
+			db = SingleOutputEcospold2Importer(ei_db_path,ei_db_name, extractor=ParallelEcospold2Extractor(SE_config.IMPORT_N_WORKERS))
+			print(f"parsing took {time.perf_counter() - stage_start:.1f} s")
+			stage_start = time.perf_counter()
 			db.apply_strategies()
+			print(f"apply_strategies took {time.perf_counter() - stage_start:.1f} s")
 			db.statistics()
+			stage_start = time.perf_counter()
 			db.write_database()
+			print(f"write_database took {time.perf_counter() - stage_start:.1f} s")
 	else:
 		print(f"[caution] the db name you provided does not match any of the following: {db_supported}!!", "\n")
 
@@ -220,13 +338,20 @@ if __name__ == '__main__':
 	act_identified_df = search_ei_act(ei_act_overview_df,keywords_list)
 	#print(act_identified_df)
 
-	act_sheet = pd.concat([act_sheet,act_identified_df])
+	act_sheet = pd.concat([act_sheet,act_identified_df]).drop_duplicates(subset=['name','location']) # avoid running the same activity twice
 	#print(act_sheet)
 
 	# calculate the LCIA results
-	lcia_results_df = calc_lca(act_sheet,lcia_method_sheet, db)
-	#print (lcia_results_df)
+	calc_options = {'match_mode': SE_config.ACT_MATCH_MODE, 'mode': SE_config.CALC_MODE, 'block_size': SE_config.BLOCK_SIZE,
+					'n_workers': SE_config.N_WORKERS, 'result_cache_path': SE_config.RESULT_CACHE_PATH}
+	if SE_config.STREAM_FORMAT is not None:
+		# the results are written to the output folder block by block, as they are calculated
+		calc_lca(act_sheet,lcia_method_sheet, db, stream_output_stem=os.path.sep.join([output_path,'LCA results']),
+				stream_format=SE_config.STREAM_FORMAT, **calc_options)
+	else:
+		lcia_results_df = calc_lca(act_sheet,lcia_method_sheet, db, **calc_options)
+		#print (lcia_results_df)
 
-	# exprot the results as .csv file
-	export_name = 'LCA results.csv'
-	lcia_results_df.to_csv(os.path.sep.join([output_path,export_name]))
\ No newline at end of file
+		# exprot the results as .csv file
+		export_name = 'LCA results.csv'
+		lcia_results_df.to_csv(os.path.sep.join([output_path,export_name]))
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""
+This helper script contains the import of the ecoinvent db of lca_calculator_bw2.py
+	- ParallelEcospold2Extractor: parses the EcoSpold2 datasets with a configurable number of worker processes
+	  (same as ParallelEcospold2Extractor of lca_ei_db_mgmt_bw2, the two tools do not share their utilities)
+
+"""
+
+"""
+================
+Import libraries
+================
+"""
+from bw2io.extractors import Ecospold2DataExtractor
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import os
+
+
+class ParallelEcospold2Extractor(Ecospold2DataExtractor):
+	"""
+	extracts EcoSpold2 datasets with a configurable number of worker processes
+		- pass an instance as the 'extractor' of SingleOutputEcospold2Importer, e.g.,
+		  SingleOutputEcospold2Importer(db_path, db_name, extractor=ParallelEcospold2Extractor(n_workers=8))
+		- bw2io's own 'use_mp=True' always uses all the cores of the machine
+	"""
+
+	def __init__(self, n_workers: int, chunksize=50):
+		self.n_workers = n_workers
+		self.chunksize = chunksize # number of datasets sent to a worker at a time
+
+
+	def extract(self, dirpath, db_name, use_mp=True):
+		assert os.path.exists(dirpath), f"{dirpath} does not exist"
+		if os.path.isdir(dirpath):
+			filelist = [filename for filename in os.listdir(dirpath)
+						if os.path.isfile(os.path.join(dirpath, filename)) and filename.split(".")[-1].lower() == "spold"]
+		else:
+			dirpath, filelist = os.path.dirname(dirpath), [os.path.basename(dirpath)]
+
+		print(f"Extracting XML data from {len(filelist)} datasets with {self.n_workers} worker(s)")
+		if use_mp and self.n_workers > 1:
+			with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+				data = list(pool.map(Ecospold2DataExtractor.extract_activity, repeat(dirpath), filelist, repeat(db_name),
+									chunksize=self.chunksize))
+		else:
+			data = [Ecospold2DataExtractor.extract_activity(dirpath, filename, db_name) for filename in filelist]
+
+		return data
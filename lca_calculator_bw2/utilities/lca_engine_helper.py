@@ -0,0 +1,378 @@
+"""
+This helper script contains the calculation engine used by lca_calculator_bw2.py
+	- stack_characterization: stacks the characterization factors of many LCIA methods into ONE sparse matrix
+	- LCASystem: holds the technosphere/biosphere matrices of a database and the factorization of the technosphere
+		* load_or_build: loads the processed matrices from the on-disk cache of the project (or builds and caches them)
+		* ensure_cached: builds the on-disk cache if needed, without loading it
+		* score_stacked / score_batched: scores of given functional units (one solve per functional unit)
+		* adjoint_unit_scores: per-unit scores of EVERY product of the database (one transposed solve per method)
+	- score_parallel: shards the functional units across a process pool, each worker factorizes the technosphere once
+
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import brightway2 as bw
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+import traceback
+import uuid
+from typing import Dict, List, Tuple
+
+
+def stack_characterization(lcia_methods: List[Tuple], biosphere_dict: Dict) -> sparse.csr_matrix:
+	"""
+	stacks the characterization factors of the LCIA methods into a (methods x biosphere flows) sparse matrix
+		- row i of the matrix is the diagonal of the characterization matrix of lcia_methods[i]
+		- flows that are not part of the biosphere matrix are skipped (same as in bw2calc)
+		- only the global characterization factors are kept, i.e., the regionalized ones are skipped (same as in bw2calc's
+		  LCA.load_lcia_data) -> the scores are the same as in 'per_activity' mode
+	Params:
+		- lcia_methods: a list of LCIA methods of interest: [(method1),(method2)...]
+		- biosphere_dict: {biosphere flow key: row index in the biosphere matrix}
+	"""
+	global_location = bw.config.global_location
+	rows, cols, vals = [], [], []
+	for row, method in enumerate(lcia_methods):
+		for cf in bw.Method(method).load(): # [flow key, cf] or [flow key, cf, location]
+			flow_key = tuple(cf[0]) if isinstance(cf[0], list) else cf[0]
+			location = (tuple(cf[2]) if isinstance(cf[2], list) else cf[2]) if len(cf) > 2 else global_location
+			if flow_key not in biosphere_dict or location != global_location:
+				continue
+			rows.append(row)
+			cols.append(biosphere_dict[flow_key])
+			vals.append(cf[1]['amount'] if isinstance(cf[1], dict) else cf[1])
+
+	# [note] duplicated (method, flow) entries are summed, same as in the characterization matrix of bw2calc
+	return sparse.csr_matrix((vals, (rows, cols)), shape=(len(lcia_methods), len(biosphere_dict)))
+
+
+def db_fingerprint() -> str:
+	"""
+	returns a fingerprint of the databases of the current project
+		- it changes whenever a database is written (e.g., write_database), processed or removed (e.g., remove_db)
+	"""
+	db_stamps = []
+	for db_name in sorted(bw.databases):
+		meta = bw.databases[db_name]
+		db_stamps.append((db_name, meta.get('modified'), meta.get('processed'), meta.get('number'), sorted(meta.get('depends', []))))
+	return hashlib.sha1(repr((bw.projects.current, db_stamps)).encode('utf-8')).hexdigest()[:16]
+
+
+class LCASystem:
+	"""
+	holds the technosphere/biosphere matrices of a database and the factorization of the technosphere (A=LU),
+	so that the scores of an activity for ALL the LCIA methods come from one solve and two sparse products:
+		scores = char_stack @ (biosphere_matrix @ supply), with technosphere_matrix @ supply = demand
+	"""
+
+	def __init__(self, technosphere_matrix, biosphere_matrix, activity_dict: Dict, product_dict: Dict, biosphere_dict: Dict,
+					col_order=None):
+		self.technosphere_matrix = technosphere_matrix.tocsc()
+		self.biosphere_matrix = biosphere_matrix.tocsr()
+		self.activity_dict = activity_dict
+		self.product_dict = product_dict
+		self.biosphere_dict = biosphere_dict
+
+		# factorize the technosphere matrix ONCE
+		if col_order is None:
+			self.lu = splu(self.technosphere_matrix)
+			self.col_order = np.argsort(self.lu.perm_c) # fill-reducing column ordering found by SuperLU
+			self._sol_order = None
+		else:
+			# reuse the column ordering of a previous factorization (e.g., from the cache), only the numeric factorization is redone
+			# [note] SuperLU objects can not be pickled, so the factors themselves can not be cached
+			self.col_order = np.asarray(col_order)
+			self.lu = splu(self.technosphere_matrix[:, self.col_order].tocsc(), permc_spec='NATURAL')
+			self._sol_order = np.argsort(self.col_order)
+
+
+	@classmethod
+	def from_lca(cls, lca):
+		"""
+		creates the system from a bw2calc LCA object whose lci data have been loaded (e.g., after lca.lci())
+		"""
+		return cls(lca.technosphere_matrix, lca.biosphere_matrix, lca.activity_dict, lca.product_dict, lca.biosphere_dict)
+
+
+	def build_demand_array(self, demand: Dict) -> np.ndarray:
+		"""
+		Params:
+			- demand: {activity key: amount}
+		"""
+		demand_array = np.zeros(len(self.product_dict))
+		for key, amount in demand.items():
+			demand_array[self.product_dict[key]] += amount
+		return demand_array
+
+
+	def solve(self, rhs: np.ndarray, trans='N') -> np.ndarray:
+		"""
+		solves A x = rhs (trans='N') or A^T x = rhs (trans='T'), rhs can have one column per right-hand side
+		"""
+		if self._sol_order is None:
+			return self.lu.solve(rhs, trans=trans)
+		# the factorized matrix is A[:, col_order]
+		if trans == 'N':
+			return self.lu.solve(rhs)[self._sol_order]
+		return self.lu.solve(np.asfortranarray(rhs[self.col_order]), trans=trans)
+
+
+	def save(self, cache_dir: str):
+		"""
+		saves the processed matrices, the dicts and the column ordering of the factorization to cache_dir
+			- written to a temporary folder first and then renamed, so that other processes never load a partial cache
+		"""
+		tmp_dir = f"{cache_dir}.tmp_{uuid.uuid4().hex}"
+		os.makedirs(tmp_dir)
+		sparse.save_npz(os.path.sep.join([tmp_dir, 'technosphere_matrix.npz']), self.technosphere_matrix)
+		sparse.save_npz(os.path.sep.join([tmp_dir, 'biosphere_matrix.npz']), self.biosphere_matrix)
+		np.save(os.path.sep.join([tmp_dir, 'col_order.npy']), self.col_order)
+		with open(os.path.sep.join([tmp_dir, 'dicts.pickle']), 'wb') as f:
+			pickle.dump((self.activity_dict, self.product_dict, self.biosphere_dict), f, protocol=pickle.HIGHEST_PROTOCOL)
+		try:
+			os.rename(tmp_dir, cache_dir)
+		except OSError: # another process has saved the same cache in the meantime
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+	@classmethod
+	def load(cls, cache_dir: str):
+		technosphere_matrix = sparse.load_npz(os.path.sep.join([cache_dir, 'technosphere_matrix.npz']))
+		biosphere_matrix = sparse.load_npz(os.path.sep.join([cache_dir, 'biosphere_matrix.npz']))
+		col_order = np.load(os.path.sep.join([cache_dir, 'col_order.npy']))
+		with open(os.path.sep.join([cache_dir, 'dicts.pickle']), 'rb') as f:
+			activity_dict, product_dict, biosphere_dict = pickle.load(f)
+		return cls(technosphere_matrix, biosphere_matrix, activity_dict, product_dict, biosphere_dict, col_order=col_order)
+
+
+	@staticmethod
+	def cache_dir(lca, cache_root=None) -> str:
+		"""
+		returns the cache folder of the system of a bw2calc LCA object (created, lci data not loaded yet)
+			- the folder name is made of the hash of the processed db files the LCA object uses (i.e., the db the functional unit
+			  depends on) and the fingerprint of the db of the project (see db_fingerprint()) -> a functional unit of another
+			  db gets its own cache, and writing or removing any db changes the folder (the old one is stale)
+		Params:
+			- cache_root: the folder of the caches, defaults to the 'calc_cache' folder of the current brightway2 project
+		"""
+		if cache_root is None:
+			cache_root = os.path.sep.join([bw.projects.dir, 'calc_cache'])
+		os.makedirs(cache_root, exist_ok=True)
+		db_files_hash = hashlib.sha1(repr((bw.projects.current, sorted(lca.database_filepath))).encode('utf-8')).hexdigest()[:12]
+		return os.path.sep.join([cache_root, f"lca_system_{db_files_hash}_{db_fingerprint()}"])
+
+
+	@classmethod
+	def _build_and_cache(cls, lca, cache_dir: str):
+		print("building the matrices of the LCA system (cached for later runs)")
+		lca.load_lci_data()
+		lca_system = cls.from_lca(lca)
+
+		# remove the stale caches of the same db files (not the temporary folders of caches being saved), then save the new one
+		for stale_dir in glob.glob(f"{glob.escape(cache_dir.rsplit('_', 1)[0])}_*"):
+			if stale_dir != cache_dir and '.tmp_' not in os.path.basename(stale_dir):
+				shutil.rmtree(stale_dir, ignore_errors=True)
+		lca_system.save(cache_dir)
+
+		return lca_system
+
+
+	@classmethod
+	def load_or_build(cls, first_demand: Tuple, cache_root=None):
+		"""
+		loads the system from the on-disk cache of the current project, or builds it from bw2calc (and caches it)
+			- the cache is keyed by the db files of the LCA object of first_demand and the fingerprint of the databases
+			  (see cache_dir()), so it is invalidated automatically when a database is written or removed; stale caches are
+			  deleted when a new one is built
+		Params:
+			- first_demand: (activity key, amount) of any activity of the database, used to build the LCA object
+			- cache_root: the folder of the caches, see cache_dir()
+		"""
+		lca = bw.LCA({first_demand[0]: first_demand[1]})
+		cache_dir = cls.cache_dir(lca, cache_root)
+		if os.path.isdir(cache_dir):
+			return cls.load(cache_dir)
+		return cls._build_and_cache(lca, cache_dir)
+
+
+	@classmethod
+	def ensure_cached(cls, first_demand: Tuple, cache_root=None) -> str:
+		"""
+		makes sure the on-disk cache of the current project is up-to-date, WITHOUT loading it (e.g., before starting worker
+		processes that load it), returns the cache folder
+			- if the cache is missing, the system is built and factorized once here, to save the column ordering of the
+			  factorization that all the loads reuse
+		Params: see load_or_build()
+		"""
+		lca = bw.LCA({first_demand[0]: first_demand[1]})
+		cache_dir = cls.cache_dir(lca, cache_root)
+		if not os.path.isdir(cache_dir):
+			cls._build_and_cache(lca, cache_dir)
+		return cache_dir
+
+
+	def score_stacked(self, demand: Dict, char_stack: sparse.csr_matrix) -> np.ndarray:
+		"""
+		returns the scores of the demand for all the methods stacked in char_stack
+		"""
+		supply = self.solve(self.build_demand_array(demand))
+		return char_stack @ (self.biosphere_matrix @ supply)
+
+
+	def score_batched(self, demands: List[Tuple], char_stack: sparse.csr_matrix, block_size=256, on_block=None) -> np.ndarray:
+		"""
+		returns the scores of many functional units, solved block by block against the existing factorization
+		Params:
+			- demands: a list of (activity key, amount), one functional unit each
+			- char_stack: the stacked characterization matrix, see stack_characterization()
+			- block_size: number of functional units solved together, larger blocks are faster but need
+				2 x n_products x block_size floats of memory
+			- on_block: (optional) a function called as on_block(start, end, block_results) as soon as the block of
+				demands[start:end] is solved; if given, the results are NOT kept and None is returned
+		Returns:
+			- a (functional units x methods) array of scores
+		"""
+		results = np.zeros((len(demands), char_stack.shape[0])) if on_block is None else None
+		for start in range(0, len(demands), block_size):
+			block = demands[start:start + block_size]
+
+			# assemble the demand matrix of the block, one column per functional unit
+			demand_matrix = np.zeros((len(self.product_dict), len(block)), order='F')
+			for col, (key, amount) in enumerate(block):
+				demand_matrix[self.product_dict[key], col] = amount
+
+			# solve all columns in one call, then characterize all of them at once
+			supply_matrix = self.solve(demand_matrix)
+			block_results = (char_stack @ (self.biosphere_matrix @ supply_matrix)).T
+			if on_block is None:
+				results[start:start + len(block), :] = block_results
+			else:
+				on_block(start, start + len(block), block_results)
+
+		return results
+
+
+	def adjoint_unit_scores(self, char_stack: sparse.csr_matrix) -> np.ndarray:
+		"""
+		returns the score of one unit of each product of the database, for all the methods stacked in char_stack
+			- the score of a demand d for method c is c B A^-1 d = (A^-T B^T c)^T d, so solving A^T x = (c B)^T once
+			  per method gives the scores of all products in one go (adjoint method)
+		Returns:
+			- a (products x methods) array, row product_dict[key] holds the scores of one unit of the product of key
+		[caution] the array is dense, i.e., n_products x n_methods floats; use score_adjoint to bound the memory
+		"""
+		rhs = np.asarray((char_stack @ self.biosphere_matrix).T.todense(), order='F') # (activities x methods)
+		return self.solve(rhs, trans='T')
+
+
+	def score_adjoint(self, demands: List[Tuple], char_stack: sparse.csr_matrix, block_size=256, on_block=None) -> np.ndarray:
+		"""
+		returns the scores of many functional units, sliced out of the adjoint unit scores (see adjoint_unit_scores)
+			- the methods are solved block by block -> the right-hand side and the unit scores take at most
+			  n_products x block_size floats, no matter the number of methods
+		Params:
+			- demands: a list of (activity key, amount), one functional unit each
+			- char_stack: the stacked characterization matrix, see stack_characterization()
+			- block_size: number of methods solved together, and number of functional units passed to on_block at a time
+			- on_block: (optional) a function called as on_block(start, end, block_results, method_start, method_end) with the
+				scores of demands[start:end] for the methods of char_stack[method_start:method_end]; if given, the results are
+				NOT kept and None is returned
+		Returns:
+			- a (functional units x methods) array of scores
+		"""
+		results = np.zeros((len(demands), char_stack.shape[0])) if on_block is None else None
+		rows = np.array([self.product_dict[key] for key, _ in demands], dtype=int)
+		amounts = np.array([amount for _, amount in demands], dtype=float)
+		for method_start in range(0, char_stack.shape[0], block_size):
+			method_end = min(method_start + block_size, char_stack.shape[0])
+			unit_scores = self.adjoint_unit_scores(char_stack[method_start:method_end])
+
+			# slice the functional units out of the unit scores, block by block
+			for start in range(0, len(demands), block_size):
+				end = min(start + block_size, len(demands))
+				block_results = unit_scores[rows[start:end], :] * amounts[start:end, np.newaxis]
+				if on_block is None:
+					results[start:end, method_start:method_end] = block_results
+				else:
+					on_block(start, end, block_results, method_start, method_end)
+
+		return results
+
+
+"""
+=====================
+parallel calculations
+=====================
+"""
+# the LCA system of a worker process, set up ONCE by _init_worker
+_WORKER_STATE = {}
+
+
+def _init_worker(project_name: str, lcia_methods: List[Tuple], first_demand: Tuple):
+	# read-only, the workers only read the project (no write lock, see bw.projects.set_current)
+	bw.projects.set_current(project_name, writable=False)
+	_WORKER_STATE['lca_system'] = LCASystem.load_or_build(first_demand)
+	_WORKER_STATE['char_stack'] = stack_characterization(lcia_methods, _WORKER_STATE['lca_system'].biosphere_dict)
+
+
+def _score_shard(shard_idx: int, demands: List[Tuple], block_size: int) -> Tuple[int, np.ndarray]:
+	lca_system = _WORKER_STATE['lca_system']
+	return shard_idx, lca_system.score_batched(demands, _WORKER_STATE['char_stack'], block_size=block_size)
+
+
+def score_parallel(project_name: str, demands: List[Tuple], lcia_methods: List[Tuple], n_workers: int, block_size=256,
+					shards_per_worker=4, on_shard=None) -> Tuple[np.ndarray, Dict]:
+	"""
+	scores the functional units in a process pool
+	Params:
+		- project_name: name of the brightway2 project (each worker process sets it as current)
+		- demands: a list of (activity key, amount), one functional unit each
+		- lcia_methods: a list of LCIA methods of interest: [(method1),(method2)...]
+		- n_workers: number of worker processes, each of them loads (from the cache) and factorizes the technosphere ONCE
+		- block_size: see LCASystem.score_batched()
+		- shards_per_worker: the functional units are split into n_workers x shards_per_worker shards, for load balancing
+		- on_shard: (optional) a function called as on_shard(start, end, shard_results) as soon as the shard of
+			demands[start:end] is done; if given, the results are NOT kept and results is None
+	Returns:
+		- results: a (functional units x methods) array of scores, in the order of demands
+		- failed_shards: {(first row, last row + 1): error msg} of the shards that failed, their rows are NaN in results
+	"""
+	results = np.full((len(demands), len(lcia_methods)), np.nan) if on_shard is None else None
+	failed_shards = {}
+
+	# split the functional units into contiguous shards
+	n_shards = max(1, min(len(demands), n_workers * shards_per_worker))
+	bounds = np.linspace(0, len(demands), n_shards + 1).astype(int)
+	shards = [(bounds[idx], bounds[idx + 1]) for idx in range(n_shards) if bounds[idx] < bounds[idx + 1]]
+
+	# make sure the matrices are cached before the workers start, so that they load them instead of rebuilding them
+	# [note] an up-to-date cache is not loaded (i.e., not factorized) in this process
+	LCASystem.ensure_cached(demands[0])
+
+	with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(project_name, lcia_methods, demands[0])) as pool:
+		futures = {pool.submit(_score_shard, shard_idx, demands[start:end], block_size): shard_idx for shard_idx, (start, end) in enumerate(shards)}
+		for future in as_completed(futures):
+			start, end = shards[futures[future]]
+			try:
+				_, shard_results = future.result()
+				if on_shard is None:
+					results[start:end, :] = shard_results
+				else:
+					on_shard(start, end, shard_results)
+			except Exception: # an error in one shard should not lose the others
+				exceptiondata = traceback.format_exc().splitlines()
+				failed_shards[(start, end)] = exceptiondata[-1]
+				print(f"[ERROR msg] shard of rows {start}-{end - 1} failed: {exceptiondata[-1]}")
+
+	return results, failed_shards
@@ -0,0 +1,314 @@
+"""
+This helper script contains the lookup indices used by lca_calculator_bw2.py
+	- SubstringIndex: answers substring queries over a list of strings
+	- ActOverviewIndex: (activity name, geography) index over the ecoinvent activity overview
+	- ActivityIndex: (name, location, reference product) -> activity key index over an imported database
+	- MethodResolver: resolves the rows of the 'LCIA_methods' sheet to the impact assessment methods installed
+
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import brightway2 as bw
+import pandas as pd
+from bisect import bisect_right
+import hashlib
+import os
+import pickle
+from typing import List, Tuple
+
+
+class SubstringIndex:
+	"""
+	indexes a list of strings for substring queries
+		- all strings are normalized (lowercased) once and joined into a single text blob, so that each query is
+		  answered by the C-level str.find() instead of a Python loop over every string
+		- query() returns the positions of the matching strings (unique and sorted)
+	"""
+
+	# separator between the indexed strings, it must not appear in any of them
+	SEP = "\n"
+
+	def __init__(self, values: List[str], case_sensitive=False):
+		self.values = list(values)
+		self.case_sensitive = case_sensitive
+
+		# normalize the strings once
+		texts = [self._normalize(val) for val in self.values]
+
+		# join the strings into one text blob and record where each of them starts
+		self.text = self.SEP.join(texts)
+		self.starts = []
+		offset = 0
+		for text in texts:
+			self.starts.append(offset)
+			offset += len(text) + len(self.SEP)
+
+
+	def _normalize(self, value) -> str:
+		value = str(value).replace(self.SEP, " ")
+		return value if self.case_sensitive else value.lower()
+
+
+	def query(self, substring: str) -> List[int]:
+		"""
+		returns the positions of all the strings containing the substring
+		"""
+		substring = self._normalize(substring)
+
+		# an empty substring is part of every string
+		if not substring:
+			return list(range(len(self.values)))
+
+		hits = []
+		pos = self.text.find(substring)
+		while pos != -1:
+			idx = bisect_right(self.starts, pos) - 1
+			hits.append(idx)
+			# jump to the start of the next string, one hit per string is enough
+			if idx + 1 >= len(self.starts):
+				break
+			pos = self.text.find(substring, self.starts[idx + 1])
+
+		return hits
+
+
+class ActOverviewIndex:
+	"""
+	indexes the unique (activity name, geography) pairs of the ecoinvent activity overview
+		- 'activity_overview_3.6_undefined_public_1.xlsx' lists the same activity once per 'product name', the index
+		  only keeps one entry per (activity name, geography), so that co-products do not lead to duplicated LCA runs
+	"""
+
+	def __init__(self, ei_act_overview_df: pd.DataFrame, name_col='activity name', loc_col='geography'):
+		# keep the unique (activity name, geography) pairs, in the order they appear in the overview
+		act_loc_df = ei_act_overview_df[[name_col, loc_col]].drop_duplicates()
+		self.act_loc_list = list(zip(act_loc_df[name_col].tolist(), act_loc_df[loc_col].tolist()))
+
+		# substring index over the activity names
+		self.name_index = SubstringIndex([act for act, _ in self.act_loc_list])
+
+		# lookup from (lowercased) geography to the positions of the pairs
+		self.loc_dict = {}
+		for idx, (_, loc) in enumerate(self.act_loc_list):
+			self.loc_dict.setdefault(str(loc).lower(), set()).add(idx)
+
+
+	def search(self, keywords_list: List[Tuple]) -> List[Tuple]:
+		"""
+		returns the unique (activity name, geography) pairs matching any of the (keyword, location) tuples
+			- keyword: part of the activity name (case-insensitive)
+			- location: exact geography (case-insensitive), or 'unspecified' for any geography
+		"""
+		hits_seen = set()
+		act_loc_identified = []
+
+		for kw, loc in keywords_list:
+			hits = self.name_index.query(kw)
+			if str(loc).lower() != 'unspecified':
+				loc_hits = self.loc_dict.get(str(loc).lower(), set())
+				hits = [idx for idx in hits if idx in loc_hits]
+			for idx in hits:
+				if idx not in hits_seen:
+					hits_seen.add(idx)
+					act_loc_identified.append(self.act_loc_list[idx])
+
+		return act_loc_identified
+
+
+class ActivityIndex:
+	"""
+	indexes the activities of an imported database by name, location and reference product
+		- built ONCE per database (one pass over the db) and pickled in the folder of the current brightway2 project
+		- the pickled index is rebuilt automatically when the database is modified (e.g., re-imported)
+	Methods of this class:
+		- resolve: resolves a list of (name, location[, reference product]) tuples to the positions of the activities
+		- get_keys / get_records: return the activity keys / attributes of the resolved activities
+	"""
+
+	def __init__(self, db_name: str, cache_dir=None):
+		self.db_name = db_name
+		if cache_dir is None:
+			cache_dir = os.path.sep.join([bw.projects.dir, 'calc_cache'])
+		os.makedirs(cache_dir, exist_ok=True)
+		db_stem = "".join(c if c.isalnum() else "_" for c in db_name)
+		self.cache_path = os.path.sep.join([cache_dir, f"{db_stem}_act_index.pickle"])
+
+		# load the index if it is up-to-date, otherwise (re)build it
+		stamp = self._db_stamp()
+		self.data = None
+		if os.path.exists(self.cache_path):
+			with open(self.cache_path, 'rb') as f:
+				cached = pickle.load(f)
+			if cached['stamp'] == stamp:
+				self.data = cached['data']
+		if self.data is None:
+			self.data = self._build()
+			with open(self.cache_path, 'wb') as f:
+				pickle.dump({'stamp': stamp, 'data': self.data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+		# exact lookup: (name, location) -> positions
+		self.exact_dict = {}
+		for idx, name_loc in enumerate(zip(self.data['name'], self.data['location'])):
+			self.exact_dict.setdefault(name_loc, []).append(idx)
+
+		# substring lookup (case-sensitive, same as the 'in' test it replaces)
+		self.name_index = SubstringIndex(self.data['name'], case_sensitive=True)
+		self.loc_index = SubstringIndex(self.data['location'], case_sensitive=True)
+		self.ref_prod_index = SubstringIndex(self.data['reference product'], case_sensitive=True)
+
+
+	def _db_stamp(self) -> Tuple:
+		"""
+		returns a stamp that changes whenever the database is (re)written
+		"""
+		return (bw.databases[self.db_name].get('modified'), len(bw.Database(self.db_name)))
+
+
+	def _build(self) -> dict:
+		print(f"building the activity index of {self.db_name}")
+		data = {'key': [], 'name': [], 'location': [], 'reference product': [], 'unit': []}
+		for act in bw.Database(self.db_name):
+			data['key'].append(act.key)
+			data['name'].append(act.get('name', ''))
+			data['location'].append(act.get('location', ''))
+			data['reference product'].append(act.get('reference product', ''))
+			data['unit'].append(act.get('unit', ''))
+		return data
+
+
+	def resolve(self, act_loc_tuples: List[Tuple], mode='substring') -> List[int]:
+		"""
+		resolves the activities of interest in one go
+		Params:
+			- act_loc_tuples: a list of (name, location) or (name, location, reference product)
+			- mode:
+				* 'exact': name, location (and reference product, if given) are the same as those of the activity
+				* 'substring': name, location (and reference product, if given) are part of those of the activity
+		Returns:
+			- unique positions of the activities identified, in the order of the database
+		"""
+		hits = set()
+		if mode == 'exact':
+			for act_loc_tuple in act_loc_tuples:
+				positions = self.exact_dict.get((act_loc_tuple[0], act_loc_tuple[1]), [])
+				if len(act_loc_tuple) > 2:
+					positions = [idx for idx in positions if self.data['reference product'][idx] == act_loc_tuple[2]]
+				hits.update(positions)
+		elif mode == 'substring':
+			loc_hits_dict = {} # many tuples share the same location
+			for act_loc_tuple in act_loc_tuples:
+				if act_loc_tuple[1] not in loc_hits_dict:
+					loc_hits_dict[act_loc_tuple[1]] = set(self.loc_index.query(act_loc_tuple[1]))
+				positions = loc_hits_dict[act_loc_tuple[1]].intersection(self.name_index.query(act_loc_tuple[0]))
+				if len(act_loc_tuple) > 2:
+					positions = positions.intersection(self.ref_prod_index.query(act_loc_tuple[2]))
+				hits.update(positions)
+		else:
+			raise ValueError(f"unknown mode '{mode}', use 'exact' or 'substring'")
+
+		return sorted(hits)
+
+
+	def get_keys(self, positions: List[int]) -> List[Tuple]:
+		return [self.data['key'][idx] for idx in positions]
+
+
+	def get_records(self, positions: List[int]) -> pd.DataFrame:
+		return pd.DataFrame({field: [self.data[field][idx] for idx in positions] for field in ['name', 'location', 'unit']})
+
+
+class MethodResolver:
+	"""
+	resolves the rows of the 'LCIA_methods' sheet (LCIA_method_lvl_0/1/2) to the impact assessment methods installed
+		- each level of the installed method tuples is indexed ONCE: the distinct names of the level are put in a
+		  SubstringIndex and each distinct name points to a bit mask of the methods using it
+		- a row matches a method if its lvl_0/1/2 entries are part of the method's 1st/2nd/3rd names, so the methods
+		  matching a row are the AND of three bit masks (instead of a scan over all methods for every row)
+		- resolved sheets are pickled in the folder of the current brightway2 project, keyed by the installed methods
+		  and the content of the sheet
+	"""
+
+	LEVEL_HEADERS = ['LCIA_method_lvl_0', 'LCIA_method_lvl_1', 'LCIA_method_lvl_2']
+
+	def __init__(self, cache_dir=None):
+		if cache_dir is None:
+			cache_dir = os.path.sep.join([bw.projects.dir, 'calc_cache'])
+		os.makedirs(cache_dir, exist_ok=True)
+		self.cache_path = os.path.sep.join([cache_dir, "lcia_methods_resolved.pickle"])
+
+		self.method_list = list(bw.methods)
+		self.methods_stamp = hashlib.sha1(repr(self.method_list).encode('utf-8')).hexdigest()
+		self.level_indices = None # built on first use
+
+
+	def _build_level_indices(self):
+		"""
+		builds, for each level, (SubstringIndex of the distinct names, bit mask of the methods for each distinct name)
+		"""
+		self.level_indices = []
+		for level in range(len(self.LEVEL_HEADERS)):
+			mask_dict = {}
+			for idx, bw_method in enumerate(self.method_list):
+				name = bw_method[level] if len(bw_method) > level else ''
+				mask_dict[name] = mask_dict.get(name, 0) | (1 << idx)
+			names = list(mask_dict.keys())
+			self.level_indices.append((SubstringIndex(names, case_sensitive=True), [mask_dict[name] for name in names], {}))
+
+
+	def _query_level(self, level: int, substring: str) -> int:
+		"""
+		returns the bit mask of the methods whose name at the given level contains the substring
+		"""
+		name_index, masks, memo = self.level_indices[level]
+		if substring not in memo:
+			mask = 0
+			for pos in name_index.query(substring):
+				mask |= masks[pos]
+			memo[substring] = mask
+		return memo[substring]
+
+
+	def resolve(self, lcia_method_sheet: pd.DataFrame) -> Tuple[List[Tuple], pd.DataFrame]:
+		"""
+		resolves the whole sheet in one call
+		Returns:
+			- lcia_methods: the unique methods matched by any row, in the order of bw2data.methods
+			- unmatched_rows_df: the rows of the sheet that do not match any installed method
+		"""
+		rows = list(zip(*[lcia_method_sheet[header].astype(str).tolist() for header in self.LEVEL_HEADERS]))
+		sheet_stamp = hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+
+		# use the cached result if neither the installed methods nor the sheet have changed
+		cached = {}
+		if os.path.exists(self.cache_path):
+			with open(self.cache_path, 'rb') as f:
+				cached = pickle.load(f)
+			if cached.get('methods_stamp') != self.methods_stamp:
+				cached = {}
+		if sheet_stamp in cached.get('sheets', {}):
+			lcia_methods, unmatched_positions = cached['sheets'][sheet_stamp]
+		else:
+			if self.level_indices is None:
+				self._build_level_indices()
+			matched_mask = 0
+			unmatched_positions = []
+			for pos, row in enumerate(rows):
+				row_mask = self._query_level(0, row[0]) & self._query_level(1, row[1]) & self._query_level(2, row[2])
+				if row_mask:
+					matched_mask |= row_mask
+				else:
+					unmatched_positions.append(pos)
+			lcia_methods = [bw_method for idx, bw_method in enumerate(self.method_list) if (matched_mask >> idx) & 1]
+
+			# update the cache
+			cached = {'methods_stamp': self.methods_stamp, 'sheets': {**cached.get('sheets', {}), sheet_stamp: (lcia_methods, unmatched_positions)}}
+			with open(self.cache_path, 'wb') as f:
+				pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+		unmatched_rows_df = lcia_method_sheet.iloc[unmatched_positions]
+
+		return lcia_methods, unmatched_rows_df
@@ -0,0 +1,95 @@
+"""
+This helper script contains the local store of the LCIA results calculated by lca_calculator_bw2.py
+	- ResultCache: SQLite store of the scores of (activity, method) pairs, so that later runs only calculate the missing pairs
+
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import numpy as np
+import json
+import os
+import sqlite3
+from typing import List, Tuple
+
+
+class ResultCache:
+	"""
+	stores the LCIA results of (activity, method) pairs in a local SQLite database
+		- keyed by the fingerprint of the databases (see lca_engine_helper.db_fingerprint), the activity key and the method
+		- the amount a score was calculated for is stored with it: LCA is linear, so the score is rescaled to any other amount
+		- results are committed block by block -> an interrupted run resumes from the blocks already stored
+	Methods of this class:
+		- lookup: returns the cached scores of the (activity, method) pairs of interest (NaN if missing)
+		- store: stores the scores of a block of activities
+	"""
+
+	# max. number of activities per query (SQLite limits the number of variables of a query)
+	QUERY_CHUNK = 500
+
+	def __init__(self, db_path: str):
+		self.db_path = db_path
+		if os.path.dirname(db_path):
+			os.makedirs(os.path.dirname(db_path), exist_ok=True)
+		self.conn = sqlite3.connect(db_path)
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS scores ("
+			"fingerprint TEXT, act_key TEXT, method TEXT, amount REAL, score REAL, "
+			"PRIMARY KEY (fingerprint, act_key, method))"
+			)
+		self.conn.commit()
+
+
+	@staticmethod
+	def _to_text(key_or_method: Tuple) -> str:
+		return json.dumps(list(key_or_method))
+
+
+	def lookup(self, fingerprint: str, demands: List[Tuple], lcia_methods: List[Tuple]) -> np.ndarray:
+		"""
+		Params:
+			- fingerprint: fingerprint of the databases the scores are calculated with
+			- demands: a list of (activity key, amount)
+			- lcia_methods: a list of LCIA methods of interest: [(method1),(method2)...]
+		Returns:
+			- a (activities x methods) array of the cached scores, rescaled to the amounts of demands; NaN if not cached
+		"""
+		results = np.full((len(demands), len(lcia_methods)), np.nan)
+		method_cols = {self._to_text(method): col for col, method in enumerate(lcia_methods)}
+
+		# an activity may appear more than once (e.g., with different amounts)
+		act_rows = {}
+		for row, (key, _) in enumerate(demands):
+			act_rows.setdefault(self._to_text(key), []).append(row)
+
+		act_texts = list(act_rows.keys())
+		for start in range(0, len(act_texts), self.QUERY_CHUNK):
+			chunk = act_texts[start:start + self.QUERY_CHUNK]
+			query = f"SELECT act_key, method, amount, score FROM scores WHERE fingerprint = ? AND act_key IN ({','.join('?' * len(chunk))})"
+			for act_text, method_text, amount, score in self.conn.execute(query, [fingerprint] + chunk):
+				if method_text not in method_cols or amount == 0:
+					continue
+				for row in act_rows[act_text]:
+					results[row, method_cols[method_text]] = score * demands[row][1] / amount
+
+		return results
+
+
+	def store(self, fingerprint: str, demands: List[Tuple], lcia_methods: List[Tuple], scores: np.ndarray):
+		"""
+		stores the (activities x methods) scores of demands, NaN scores (e.g., failed calculations) are skipped
+		"""
+		method_texts = [self._to_text(method) for method in lcia_methods]
+		records = [
+			(fingerprint, self._to_text(key), method_texts[col], amount, float(scores[row, col]))
+			for row, (key, amount) in enumerate(demands) for col in range(len(lcia_methods)) if not np.isnan(scores[row, col])
+			]
+		self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", records)
+		self.conn.commit()
+
+
+	def close(self):
+		self.conn.close()
@@ -0,0 +1,82 @@
+"""
+This helper script contains the streaming output stage of lca_calculator_bw2.py
+	- StreamingResultWriter: keeps the (activities x methods) results in a memory-mapped .npy file instead of in memory
+
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import pandas as pd
+import numpy as np
+import os
+from typing import List, Tuple
+
+
+class StreamingResultWriter:
+	"""
+	writes the LCIA results to disk block by block, as they are calculated
+		- the results live in a memory-mapped '<output_stem>.npy' (initialized with NaN), so the peak memory does not
+		  grow with the size of the (activities x methods) grid
+		- the activity attributes and the methods are written to the sidecar files '<output_stem>_index.csv' and
+		  '<output_stem>_methods.csv' BEFORE the calculation starts, and the .npy is flushed after each block ->
+		  the blocks already calculated survive a crash (rows/cells still NaN were not calculated)
+		- fmt='csv': at close(), the results are converted (chunk by chunk) to '<output_stem>.csv', with the same layout
+		  as the in-memory lcia_results_df, and the intermediate files are removed
+		- fmt='npy': the .npy and its sidecar files are the output
+	[caution] drop all the other references to self.results (e.g., lcia_results = None) before close(), otherwise the .npy stays
+			  mapped and can not be removed (Windows)
+	"""
+
+	def __init__(self, output_stem: str, attributes_df: pd.DataFrame, lcia_methods: List[Tuple], fmt='csv', chunk_size=10000):
+		if fmt not in ['csv', 'npy']:
+			raise ValueError(f"unknown output format '{fmt}', use 'csv' or 'npy'")
+		self.output_stem = output_stem
+		self.attributes_df = attributes_df.reset_index(drop=True)
+		self.lcia_methods = lcia_methods
+		self.fmt = fmt
+		self.chunk_size = chunk_size
+
+		# write the sidecar files first
+		self.attributes_df.to_csv(f"{self.output_stem}_index.csv")
+		pd.DataFrame({'method': [str(method) for method in self.lcia_methods]}).to_csv(f"{self.output_stem}_methods.csv")
+
+		# create the memory-mapped results
+		self.results = np.lib.format.open_memmap(f"{self.output_stem}.npy", mode='w+', dtype=float,
+												shape=(len(self.attributes_df), len(self.lcia_methods)))
+		for start in range(0, self.results.shape[0], self.chunk_size):
+			self.results[start:start + self.chunk_size, :] = np.nan
+		self.results.flush()
+
+
+	def flush(self):
+		self.results.flush()
+
+
+	def close(self) -> str:
+		"""
+		flushes the results and (for fmt='csv') converts them to the final .csv, returns the path to the output
+		"""
+		self.flush()
+		if self.fmt == 'npy':
+			return f"{self.output_stem}.npy"
+
+		csv_path = f"{self.output_stem}.csv"
+		for start in range(0, max(self.results.shape[0], 1), self.chunk_size):
+			end = min(start + self.chunk_size, self.results.shape[0])
+			df_tmp = self.attributes_df.iloc[start:end]
+			# [note] a copy of the chunk, a dataframe of a view would keep the file mapped
+			lcia_results_df = pd.DataFrame(np.array(self.results[start:end, :]), columns=self.lcia_methods, index=df_tmp.index)
+			pd.concat([df_tmp, lcia_results_df], axis=1).to_csv(csv_path, mode='w' if start == 0 else 'a', header=(start == 0))
+
+		# remove the intermediate files
+		del self.results
+		for suffix in ['.npy', '_index.csv', '_methods.csv']:
+			try:
+				os.remove(f"{self.output_stem}{suffix}")
+			except OSError as error: # e.g., the .npy is still mapped by another reference to the results (Windows)
+				print(f"[caution] the intermediate file {self.output_stem}{suffix} could not be removed: {error}")
+
+		return csv_path
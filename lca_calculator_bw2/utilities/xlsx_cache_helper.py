@@ -0,0 +1,106 @@
+"""
+This helper script caches the sheets of the input workbooks in a fast binary form
+	- parsing .xlsx is the slowest part of the start-up of lca_calculator_bw2.py, so each sheet is converted ONCE
+	  into a Feather file (or a pickle, if pyarrow is not installed or the sheet cannot be stored as Feather)
+	- the cache is keyed by the path, size and mtime of the workbook -> it is rebuilt automatically when the workbook changes
+
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import pandas as pd
+import hashlib
+import glob
+import os
+from typing import Dict, List
+
+try:
+	import pyarrow # required by pd.DataFrame.to_feather
+	FEATHER_AVAILABLE = True
+except ImportError:
+	FEATHER_AVAILABLE = False
+
+
+def _workbook_stamp(wb_path: str) -> str:
+	"""
+	returns a short hash of (path, size, mtime) of the workbook
+	"""
+	stat = os.stat(wb_path)
+	stamp = f"{os.path.abspath(wb_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+	return hashlib.sha1(stamp.encode('utf-8')).hexdigest()[:16]
+
+
+def _cache_prefix(wb_path: str, sheet_name: str, cache_dir: str) -> str:
+	"""
+	returns the prefix of the cache files of a sheet, unique to (absolute path of the workbook, sheet name)
+		- the stale caches of the sheet are the files with this prefix, so it must not be shared with other workbooks
+		  (e.g., same file name in another folder) or sheets (e.g., names that only differ by non-alphanumeric chars)
+	"""
+	wb_stem = os.path.splitext(os.path.basename(wb_path))[0]
+	sheet_stem = "".join(c if c.isalnum() else "_" for c in sheet_name)
+	sheet_hash = hashlib.sha1(f"{os.path.abspath(wb_path)}|{sheet_name}".encode('utf-8')).hexdigest()[:8]
+	return os.path.sep.join([cache_dir, f"{wb_stem}__{sheet_stem}__{sheet_hash}__"])
+
+
+def _load_cached_sheet(cache_prefix: str, stamp: str):
+	"""
+	returns the cached sheet, or None if there is no valid cache
+	"""
+	if FEATHER_AVAILABLE and os.path.exists(f"{cache_prefix}{stamp}.feather"):
+		return pd.read_feather(f"{cache_prefix}{stamp}.feather")
+	if os.path.exists(f"{cache_prefix}{stamp}.pickle"):
+		return pd.read_pickle(f"{cache_prefix}{stamp}.pickle")
+	return None
+
+
+def _save_cached_sheet(df: pd.DataFrame, cache_prefix: str, stamp: str):
+	# remove the cache built from older versions of the workbook
+	for old_cache in glob.glob(f"{glob.escape(cache_prefix)}*"):
+		os.remove(old_cache)
+
+	if FEATHER_AVAILABLE:
+		try:
+			df.to_feather(f"{cache_prefix}{stamp}.feather")
+			return
+		except Exception:
+			# e.g., mixed types in a column or non-string headers -> fall back to pickle
+			if os.path.exists(f"{cache_prefix}{stamp}.feather"):
+				os.remove(f"{cache_prefix}{stamp}.feather")
+	df.to_pickle(f"{cache_prefix}{stamp}.pickle")
+
+
+def read_excel_cached(wb_path: str, sheet_names: List[str], cache_dir: str) -> Dict[str, pd.DataFrame]:
+	"""
+	reads the sheets of interest from a workbook, using the binary cache whenever it is up-to-date
+	Input params:
+		- wb_path: path to the workbook (.xlsx/.xls)
+		- sheet_names: a list of the names of the sheets to read
+		- cache_dir: the folder to store the cache in (created if it does not exist)
+	Output params:
+		- sheets_dict: {sheet_name: dataframe}
+	[caution]:
+		- the workbook is opened at most ONCE, for all the sheets that are missing from the cache
+	"""
+	os.makedirs(cache_dir, exist_ok=True)
+	stamp = _workbook_stamp(wb_path)
+
+	# load the sheets that are already cached
+	sheets_dict = {}
+	for sheet_name in sheet_names:
+		df = _load_cached_sheet(_cache_prefix(wb_path, sheet_name, cache_dir), stamp)
+		if df is not None:
+			sheets_dict[sheet_name] = df
+
+	# parse the missing sheets in one go and cache them
+	missing_sheets = [sheet_name for sheet_name in sheet_names if sheet_name not in sheets_dict]
+	if missing_sheets:
+		print(f"building the cache of {missing_sheets} from {wb_path}")
+		parsed_dict = pd.read_excel(wb_path, sheet_name=missing_sheets)
+		for sheet_name, df in parsed_dict.items():
+			_save_cached_sheet(df, _cache_prefix(wb_path, sheet_name, cache_dir), stamp)
+			sheets_dict[sheet_name] = df
+
+	return sheets_dict
@@ -11,21 +11,25 @@ import packages
 """
 from brightway2 import*
 from bw2io.export.excel import write_lci_matching
-from bw2analyzer import ContributionAnalysis
 import bw2data
 import stats_arrays # documentation of this package: https://stats-arrays.readthedocs.io/en/latest/
 import collections
 import pandas as pd
 import numpy as np
-import logging
 from config import db_mgmt_config as config
-from utilities.db_import_helper import MultiColImporter
+from utilities.db_import_helper import build_bkgr_importer, build_bkgr_importer_in_worker, link_to_other_db, link_index_cache
 from utilities.db_mgmt_helper import DB_mgmt
+from utilities.log_helper import get_logger
+from utilities.lca_calc_helper import LCASession, TopProcesses, TechnospherePerturbation, iter_perturbation_scores_parallel
+from utilities.mc_stats_helper import StreamingStats
+from utilities.sampling_helper import quasi_random_samples
 import os
+import time
 import traceback
 import progressbar
 import uuid
 import pickle
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from typing import List, Dict, Tuple
 
 class LCA_MOD:
@@ -43,20 +47,9 @@ class LCA_MOD:
 		set up the logger
 		=================
 		"""
-		# gets or creates a logger
-		self.logger = logging.getLogger(__name__)  
-
-		# set log level
-		self.logger.setLevel(logging.INFO)
-
-		# define file handler and set formatter
+		# gets or creates a logger (see utilities/log_helper.py)
 		log_output_path = os.path.sep.join([config.LOG_OUTPUT_PATH,'log_LCA_calculation.log'])
-		file_handler = logging.FileHandler(log_output_path)
-		formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
-		file_handler.setFormatter(formatter)
-
-		# add file handler to logger
-		self.logger.addHandler(file_handler)  
+		self.logger = get_logger(__name__, log_output_path)
 
 
 		"""
@@ -94,8 +87,11 @@ class LCA_MOD:
 		"""
 		self.db_mgmt_obj = DB_mgmt(self.project_name) #initiate the DB_mgmt object will print the already imported db again
 
+		# the LCA session (see utilities/lca_calc_helper.py) shared by calc_lca, analyze_lca and foreground_monte_carlo
+		self.lca_session = None
 
-	def import_bkgr_db (self,db_path_name_dict: Dict, db_match_dict: Dict):
+
+	def import_bkgr_db (self,db_path_name_dict: Dict, db_match_dict: Dict, n_workers=1, n_concurrent=2):
 		
 		"""
 		==============================
@@ -104,56 +100,93 @@ class LCA_MOD:
 		Params:
 			- db_path_name_dict: a dict storing name, path and type of the db to import, {db_name: (db_path, db_format, option_label)}
 			- db_match_dict: a dict storing the database name and fields to match, {db_name:('field_1','field_2',...)}
+			- n_workers: number of worker processes to parse EcoSpold2 datasets with (1: no multiprocessing)
+			- n_concurrent: max. number of databases parsed, processed and linked at the same time in worker processes
+		[note]:
+			- the time spent in each stage (parsing, apply_strategies, linking, write_database) is logged for each db
+			- the dbs are imported in the order of their dependencies (see _bkgr_db_dependencies), e.g., a customized db
+			  matched against ecoinvent is imported after ecoinvent
+			- the "ground lvl" db (e.g., ecoinvent) are built in this process, their parsing is already parallel (n_workers)
+			- the db depending on other db are built in worker processes (see db_import_helper.build_bkgr_importer_in_worker)
+			  when more than one of them can be built at the same time, otherwise in this process; all the db are linked to the
+			  other db (with the shared link_index_cache) and written one at a time by this process, as soon as they are ready,
+			  while the workers go on
+		[caution]:
+			- with worker processes, the calling script needs an "if __name__ == '__main__':" guard (see sandbox_db_mgmt.py)
+			- the data of a db built in a worker process are sent back to this process to be written, i.e., they are held in
+			  memory twice for a moment
 		"""
 		
-		# import individual databases
-		# [caution] it is NOT guaranteed that "ground lvl" db (e.g., ecoinvent) is installed before customized db (which relies on it)
-		# 			which may lead to error --> so need to explicitly import "ground lvl" db in a separate call first
-		for db_name, (db_path, db_format, option_label) in db_path_name_dict.items():
-			if db_name in self.imported_db_lst: # skip this db if it is already imported
-				print(f"DATABASE {db_name} has been imported already!!!")
-				continue
-			elif db_format.lower() == 'ecospold2':
-				import_obj = SingleOutputEcospold2Importer(db_path,db_name, use_mp=False)
-				import_obj.apply_strategies()
-			elif db_format.lower() == 'bw2 template':
-				if option_label == None:
-					import_obj = ExcelImporter(db_path)
-					import_obj.apply_strategies()
-					# need to match database
-					for db_to_match_name,fields_to_match in db_match_dict.items():
-						if  db_to_match_name == 'self':
-							import_obj.match_database(fields=fields_to_match) #link with processes in other tabs, if any
-						else:
-							import_obj.match_database(db_to_match_name,fields=fields_to_match) #match processes in other db
-				elif option_label.lower() == "multicolumn":
-					# use the helper function to handle multiple columns (e.g., multiple amounts for the same LCI row)
-					import_obj = MultiColImporter(db_path, db_name, config.MULTICOL_START, config.EXC_ROW_START, 
-													config.DEFAULT_PROC_ATTR_DICT)
-					import_obj = import_obj.buildNimport_db(db_match_dict)
-
-			# write database
-			try:
-				import_obj.statistics()
-				import_obj.write_database()
-				self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db
-			except bw2data.errors.InvalidExchange:
-				print("exception for InvalidExchange is raised!!!")
-				self.logger.info("exception for InvalidExchange is raised!!!")
-				# log the unlinked exchanges
-				self.logger.info(f"the file path to the record of unlinked exchanges: {write_lci_matching(import_obj,db_name,only_unlinked=True)}")
-				# remove the db from bw.databases
-				self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db first
-				self.db_mgmt_obj.remove_db(db_name)
-			except Exception: # catch all other exceptions 
-				exceptiondata = traceback.format_exc().splitlines()
-				exceptionarray = [exceptiondata[-1]] + [exceptiondata[-2]] #get the error msg and last line of traceback (where the error occured)
-				print(f"[ERROR msg] {exceptionarray}")
-				# remove the db from bw.databases
-				self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db first
-				self.db_mgmt_obj.remove_db(db_name)
-
-		
+		# derive the dependencies among the db to import
+		db_dependencies = self._bkgr_db_dependencies(db_path_name_dict, db_match_dict)
+
+		# import individual databases, as soon as all the db they depend on are imported
+		done_db = set(db_name for db_name in db_path_name_dict if db_name in self.imported_db_lst)
+		failed_db = set()
+		for db_name in done_db:
+			print(f"DATABASE {db_name} has been imported already!!!")
+
+		pool = None # started only when needed
+		running = {}
+		try:
+			while True:
+				# skip the db whose dependencies failed to import
+				for db_name in db_path_name_dict:
+					if db_name not in done_db | failed_db and db_dependencies[db_name] & failed_db:
+						print(f"[caution] DATABASE {db_name} is skipped, as {db_dependencies[db_name] & failed_db} failed to import")
+						failed_db.add(db_name)
+
+				# the db whose dependencies are all imported: "ground lvl" db are built here, the others in worker processes,
+				# unless only one of them can be built at the moment
+				ready_db = [db_name for db_name in db_path_name_dict if db_name not in done_db | failed_db and
+							db_name not in running.values() and db_dependencies[db_name] <= done_db]
+				local_db = [db_name for db_name in ready_db if not db_dependencies[db_name]]
+				pool_db = [db_name for db_name in ready_db if db_dependencies[db_name]]
+				if len(pool_db) == 1 and not running:
+					local_db, pool_db = local_db + pool_db, []
+
+				for db_name in pool_db:
+					if pool is None:
+						pool = ProcessPoolExecutor(max_workers=n_concurrent)
+					db_path, db_format, option_label = db_path_name_dict[db_name]
+					future = pool.submit(build_bkgr_importer_in_worker, self.project_name, db_name, db_path, db_format, option_label,
+											db_match_dict, n_workers)
+					running[future] = db_name
+
+				if local_db:
+					# build and write one db here (the workers go on), then look for the db that can be built next
+					db_name = local_db[0]
+					db_path, db_format, option_label = db_path_name_dict[db_name]
+					try:
+						import_obj, stage_timings = build_bkgr_importer(db_name, db_path, db_format, option_label, db_match_dict, n_workers)
+					except Exception: # e.g., errors while parsing or linking
+						exceptiondata = traceback.format_exc().splitlines()
+						print(f"[ERROR msg] import of {db_name} failed: {[exceptiondata[-1]] + [exceptiondata[-2]]}")
+						failed_db.add(db_name)
+						continue
+					(done_db if self._write_bkgr_db(import_obj, db_name, stage_timings) else failed_db).add(db_name)
+					continue
+
+				if not running:
+					break
+
+				# wait for any db to be ready, then write it (the workers go on with the other db)
+				finished, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in finished:
+					db_name = running.pop(future)
+					try:
+						import_obj, stage_timings = future.result()
+						# link the db to the other db here, with the indices shared by all the imports (see link_index_cache)
+						stage_timings['linking (other db)'] = link_to_other_db(import_obj, db_match_dict, link_index_cache)
+					except Exception: # e.g., errors while parsing or linking
+						exceptiondata = traceback.format_exc().splitlines()
+						print(f"[ERROR msg] import of {db_name} failed: {[exceptiondata[-1]] + [exceptiondata[-2]]}")
+						failed_db.add(db_name)
+						continue
+					(done_db if self._write_bkgr_db(import_obj, db_name, stage_timings) else failed_db).add(db_name)
+		finally:
+			if pool is not None:
+				pool.shutdown()
 
 		# log all the db loaded
 		self.logger.info("=== DATABASE IMPORTED ===")
@@ -161,6 +194,70 @@ class LCA_MOD:
 		self.logger.info(" ")
 
 
+	def _bkgr_db_dependencies (self, db_path_name_dict: Dict, db_match_dict: Dict) -> Dict:
+		"""
+		returns {db_name: set of db (to import in the same call) that db_name depends on}
+			- a 'bw2 template' db depends on the db of db_match_dict (other than 'self') it is matched against
+			- an 'ecospold2' db (e.g., ecoinvent) is only linked to biosphere3, i.e., a "ground lvl" db
+		"""
+		db_dependencies = {}
+		for db_name, (db_path, db_format, option_label) in db_path_name_dict.items():
+			if db_format.lower() == 'ecospold2':
+				db_dependencies[db_name] = set()
+			else:
+				db_dependencies[db_name] = set(db_to_match_name for db_to_match_name in db_match_dict
+											if db_to_match_name in db_path_name_dict and db_to_match_name not in ['self', db_name])
+
+		# check for circular dependencies (topological sort)
+		sorted_db, remaining_db = [], dict(db_dependencies)
+		while remaining_db:
+			ready_db = [db_name for db_name, dependencies in remaining_db.items() if dependencies <= set(sorted_db)]
+			if not ready_db:
+				raise ValueError(f"circular dependencies among the databases to import: {remaining_db}")
+			sorted_db += ready_db
+			for db_name in ready_db:
+				del remaining_db[db_name]
+		print(f"import order of the databases (dependencies first): {sorted_db}")
+
+		return db_dependencies
+
+
+	def _write_bkgr_db (self, import_obj, db_name: str, stage_timings: Dict) -> bool:
+		"""
+		writes a db built by build_bkgr_importer and logs the time spent in each stage, returns True if it has been imported successfully
+		"""
+		try:
+			import_obj.statistics()
+			stage_start = time.perf_counter()
+			import_obj.write_database()
+			stage_timings['write_database'] = time.perf_counter() - stage_start
+			self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db
+		except bw2data.errors.InvalidExchange:
+			print("exception for InvalidExchange is raised!!!")
+			self.logger.info("exception for InvalidExchange is raised!!!")
+			# log the unlinked exchanges
+			self.logger.info(f"the file path to the record of unlinked exchanges: {write_lci_matching(import_obj,db_name,only_unlinked=True)}")
+			# remove the db from bw.databases
+			self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db first
+			self.db_mgmt_obj.remove_db(db_name)
+		except Exception: # catch all other exceptions 
+			exceptiondata = traceback.format_exc().splitlines()
+			exceptionarray = [exceptiondata[-1]] + [exceptiondata[-2]] #get the error msg and last line of traceback (where the error occured)
+			print(f"[ERROR msg] {exceptionarray}")
+			# remove the db from bw.databases
+			self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db first
+			self.db_mgmt_obj.remove_db(db_name)
+		finally:
+			link_index_cache.invalidate(db_name) # drop the indices of the db written (or removed), if any
+
+		# log the time spent in each stage
+		self.logger.info(f"=== IMPORT TIMINGS OF {db_name} (seconds) ===")
+		self.logger.info({stage: round(seconds, 2) for stage, seconds in stage_timings.items()})
+		self.logger.info(" ")
+
+		return db_name in databases
+
+
 	def import_foreground_db (self, foreground_db_path_name_dict: Dict, foreground_db_match_dict: Dict):
 		
 		"""
@@ -190,7 +287,7 @@ class LCA_MOD:
 				if db_to_match_name=='self':
 					import_foreground_obj.match_database(fields=fields_to_match) #link within the foreground processes
 				else:
-					import_foreground_obj.match_database(db_to_match_name,fields=fields_to_match) #match processes in other db
+					link_index_cache.match_database(import_foreground_obj, db_to_match_name, fields=fields_to_match) #match processes in other db
 			import_foreground_obj.statistics()
 
 			try:
@@ -211,6 +308,8 @@ class LCA_MOD:
 				# remove the db from bw.databases
 				self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db first
 				self.db_mgmt_obj.remove_db(db_name)
+			finally:
+				link_index_cache.invalidate(foreground_db_name)
 
 		# log all the db loaded
 		self.logger.info("=== DATABASE IMPORTED ===")
@@ -220,12 +319,19 @@ class LCA_MOD:
 		# prepare the foregound db for lca calculation
 		self.foreground_db=Database(foreground_db_name)
 
-	def calc_lca (self,lcia_methods: List,db: str,FU_activity_code='ThisIsFU',amount_FU=1,calc_done=False):
+	def calc_lca (self,lcia_methods: List,db: str,FU_activity_code='ThisIsFU',amount_FU=1,calc_done=False,n_top_items=25):
 		"""
 		Params:
 			- lcia_methods: a list of LCIA methods of interest: [(method1),(method2)...]
 			- db: name of the foreground db of interest
 			- calc_done: a label to indicate if lca calucation has ever been performed
+			- n_top_items: number of top processes kept per method in self.top_processes_dict
+		[note]:
+			- the matrices are loaded and factorized once (self.lca_session), later calls with the same FU reuse them as long as
+			  the db are not modified, i.e., they only cost a back-substitution
+			- the matrices and the column ordering of the factorization are cached in the project folder (see
+			  lca_calc_helper.load_lci_data_cached), new sessions (e.g., in a new run or an MC worker) load them from there
+			- the top processes of a method are only calculated when self.top_processes_dict[method] is accessed
 		"""
 
 
@@ -235,33 +341,26 @@ class LCA_MOD:
 		=====================
 		"""
 		self.FU_activity_code=FU_activity_code
-		self.FU_activity=[act for act in db if act['code']==self.FU_activity_code][0]
+		self.FU_activity=get_activity((db.name, self.FU_activity_code)) # look up the FU by its key
 		self.amount_FU=amount_FU
 		self.lcia_methods=lcia_methods
 		self.calc_done=calc_done
+
+		# create or reuse the LCA session of the FU
+		demand = {self.FU_activity.key: self.amount_FU}
+		if self.lca_session is None or not self.lca_session.is_valid_for(demand, self.lcia_methods):
+			self.lca_session = LCASession(demand, self.lcia_methods)
+		self.lca = self.lca_session.lca
 	   
-		# create dict to store: (1) LCA results, (2) top processes (including backgr db)
-		self.LCA_results_dict={}
-		self.top_processes_dict={}
-		
-		# create a ContributionAnalysis object
-		self.contribut_anal_obj=ContributionAnalysis()
-
-		for method in self.lcia_methods:
-			self.lca=LCA({self.FU_activity:self.amount_FU},
-				method)
-			self.lca.lci()
-			self.lca.lcia()
-			self.LCA_results_dict[method]=self.lca.score
-			self.top_processes_dict[method]=self.contribut_anal_obj.annotated_top_processes(self.lca) #'.annotated_top_processes' returns a list of tuples: (lca score, supply, activity).
-		# [note] alternatively (maybe faster), you create a lca object and use lca.switch_method(new_method) to switch to another lcia method, then
-		# 		use lca.redo_lcia({FU_activity:amount_FU}) to calculate the result for the new lcia method
+		# store: (1) LCA results, (2) top processes (including backgr db)
+		self.LCA_results_dict = self.lca_session.scores(self.lcia_methods)
+		self.top_processes_dict = TopProcesses(self.lca_session, self.lcia_methods, n_top_items) # {method: a list of tuples: (lca score, supply, activity)}
 
 		# update the label to True
 		self.calc_done=True
 
 
-	def analyze_lca (self,impact_of_interest: Tuple,n_top_items=5,analysis_done=False):
+	def analyze_lca (self,impact_of_interest: Tuple,n_top_items=5,analysis_done=False,group_mode='adjoint'):
 		
 		"""
 		===================
@@ -271,6 +370,10 @@ class LCA_MOD:
 				(2) "group_tag" results for foreground db
 		Params:
 			- impact_of_interest: a tuple containing the impact assessment method of interest (a nest tuple)
+			- group_mode: how the "group_tag" results are calculated
+				- 'adjoint': ONE transposed solve gives the score of one unit of every product, the score of each exchange
+							 is then its amount times the unit score of its input
+				- 'per_exchange': one back-substitution per technosphere exchange of the FU
 		===================
 		"""
 		
@@ -283,15 +386,20 @@ class LCA_MOD:
 
 		while not self.analysis_done: #if analysis has not been done yet
 			# find top technosphere processes (including background db)
-			self.top_processes = {self.impact_of_interest : self.top_processes_dict[self.impact_of_interest][:self.n_top_items]}
-
-			# group the results by tag
-			for exc in self.FU_activity.technosphere():
-				self.lca2 = LCA({exc.input : exc['amount']},
-							   self.impact_of_interest)
-				self.lca2.lci()
-				self.lca2.lcia()
-				self.techno_impact_results_grouped[exc['group_tag']].append(self.lca2.score)
+			self.top_processes = {self.impact_of_interest : self.top_processes_dict.top(self.impact_of_interest, self.n_top_items)}
+
+			# group the results by tag (with the factorized system of the LCA session)
+			if group_mode == 'adjoint':
+				unit_scores = self.lca_session.unit_scores(self.impact_of_interest)
+				for exc in self.FU_activity.technosphere():
+					self.techno_impact_results_grouped[exc['group_tag']].append(
+						unit_scores[self.lca.product_dict[exc.input.key]] * exc['amount'])
+			elif group_mode == 'per_exchange':
+				for exc in self.FU_activity.technosphere():
+					self.techno_impact_results_grouped[exc['group_tag']].append(
+						self.lca_session.score_demand({exc.input.key : exc['amount']}, self.impact_of_interest))
+			else:
+				raise ValueError(f"unknown group_mode '{group_mode}', use 'adjoint' or 'per_exchange'")
 			
 			self.techno_impact_results_grouped = {key : sum(val) for key, val in self.techno_impact_results_grouped.items()}
 			
@@ -299,7 +407,7 @@ class LCA_MOD:
 			self.analysis_done = True
 	
 	
-	def parse_uncertainty (self,db,act_name: str,n_iter: int):
+	def parse_uncertainty (self,db,act_name: str,n_iter: int,seed=None,chunk_size=1000,sampling='random'):
 		"""
 		==============================================
 		Parse the uncertainty data of a given activity
@@ -307,6 +415,16 @@ class LCA_MOD:
 			- db: foreground db object
 			- act_name: str, name of the activity of interest
 			- n_iter: int, number of iterations
+			- seed: master seed of the random samples (None: not reproducible)
+			- chunk_size: number of iterations sampled with the same random stream (sampling='random' only)
+			- sampling: how the samples are drawn
+				- 'random': pseudo-random samples (stats_arrays.MCRandomNumberGenerator)
+				- 'lhs': Latin hypercube samples, 'sobol': scrambled Sobol samples (use a power of 2 for n_iter); both cover the
+						 distributions more evenly, i.e., the percentiles converge with fewer iterations (see utilities/sampling_helper.py)
+		[note]:
+			- 'random': the iterations are sampled in chunks of chunk_size, each chunk with its own random stream spawned from the
+			  master seed (np.random.SeedSequence) -> the samples only depend on seed and chunk_size
+			- 'lhs'/'sobol': all the iterations are sampled at once (the design covers all of them), the samples only depend on seed
 		==============================================
 		"""
 		# initiate the check
@@ -317,34 +435,47 @@ class LCA_MOD:
 		# identify the actitvity of interest
 		self.act_uncertain = [act for act in db if act['name']==act_name][0]
 		
-		# parse uncertainty data into a list of dicts
-		self.uncertain_list = [{'loc':exc['loc'],'scale':exc['scale'],'uncertainty type':exc['uncertainty type']} for exc in self.act_uncertain.technosphere() if exc['uncertainty type']!=0]
+		# parse uncertainty data into a list of dicts (one scan of the technosphere exchanges)
+		uncertain_excs = [exc for exc in self.act_uncertain.technosphere() if exc['uncertainty type']!=0]
+		self.uncertain_list = [{'loc':exc['loc'],'scale':exc['scale'],'uncertainty type':exc['uncertainty type']} for exc in uncertain_excs]
 		
 		""" check if uncertainty type is specified """
 		if len(self.uncertain_list) == 0:
 			print ("\n no uncertainty distribution is specified! \n")
 			self.no_uncertainty_dist=True
 		else:            
-			# get the corresponding name of the exchanges
-			self.uncertain_names = [exc['name'] for exc in self.act_uncertain.technosphere() if exc['uncertainty type']!=0]    
+			# get the corresponding input key and name of the exchanges
+			self.uncertain_keys = [exc.input.key for exc in uncertain_excs]
+			self.uncertain_names = [exc['name'] for exc in uncertain_excs]
 				
 			# create uncertainty variables
 			self.uncertain_var = stats_arrays.UncertaintyBase.from_dicts(*self.uncertain_list)
 			
-			# generate random samples
-			self.rand_sample_gen = stats_arrays.MCRandomNumberGenerator(self.uncertain_var)
-			self.rand_samples = np.array([self.rand_sample_gen.next() for _ in range(self.n_iter)])
+			if sampling == 'random':
+				# generate random samples, chunk by chunk: one vectorized draw per distribution type for all the iterations of a chunk
+				chunk_seeds = np.random.SeedSequence(seed).spawn(-(-self.n_iter // chunk_size))
+				self.rand_samples = np.zeros((self.n_iter, len(self.uncertain_list)))
+				for chunk, chunk_seed in enumerate(chunk_seeds):
+					start, end = chunk * chunk_size, min((chunk + 1) * chunk_size, self.n_iter)
+					self.rand_sample_gen = stats_arrays.MCRandomNumberGenerator(self.uncertain_var, seed=int(chunk_seed.generate_state(1)[0]))
+					self.rand_samples[start:end] = self.rand_sample_gen.generate(end - start).reshape(len(self.uncertain_list), -1).T
+			else:
+				# generate quasi-random samples (mapped through the inverse CDFs of the distributions)
+				self.rand_samples = quasi_random_samples(self.uncertain_var, self.n_iter, sampling=sampling, seed=seed)
 			
-			#link random samples to the corresponding names of exchanges
-			"""Caution: self.uncertain_names[col_i] could have the same name as self.uncertain_names[col_j], 
-					if there exist more than one of the same exchange
+			#link random samples to the input keys of the corresponding exchanges: {input key: samples}
+			"""Caution: self.uncertain_keys[col_i] could be the same as self.uncertain_keys[col_j], 
+					if there exist more than one exchange of the same input (the samples of the last one are kept)
 			"""
 			self.linked_rand_samples={}
 			for col in range(self.rand_samples.shape[1]):
-				self.linked_rand_samples[self.uncertain_names[col]]=self.rand_samples[:,col]
+				self.linked_rand_samples[self.uncertain_keys[col]]=self.rand_samples[:,col]
+
+			# [note] samples linked by exchange name, for backward compatibility (e.g., TEA models looking up the samples by name)
+			self.linked_rand_samples_by_name = dict(zip(self.uncertain_names, self.rand_samples.T))
 		
 			
-	def foreground_monte_carlo (self,linked_rand_samples: Dict):
+	def foreground_monte_carlo (self,linked_rand_samples: Dict,n_workers=1,chunk_size=250,keep_results=True,rtol=None,min_iter=500,patience=3):
 		"""
 		=====================================================================================
 		Perform Monte Carlo simulation for foreground activities only
@@ -356,14 +487,35 @@ class LCA_MOD:
 				imported already)
 		Params:
 			- linked_rand_samples: dict, random samples to evaluate for each foreground variable of interest
-				{"act_name": sample_to_eval,"act_name": sample_to_eval,... }. 
+				{input_key: sample_to_eval,input_key: sample_to_eval,... } (see '.parse_uncertainty'), the keys can also be
+				the names of the exchanges: {"act_name": sample_to_eval,"act_name": sample_to_eval,... }. 
 				*The term "linked" means the same samples are used both in LCA and TEA modeling
+			- n_workers: number of worker processes to run the iterations with (1: no multiprocessing)
+			- chunk_size: number of iterations sent to a worker at a time (if n_workers > 1), also the interval of the convergence checks
+			- keep_results: if True (default), the results of all the iterations are kept (self.foreground_MC_LCA_results and
+				self.pooled_results), i.e., the memory grows with n_iter, and the percentiles are exact; if False, only their
+				statistics are kept (constant memory), the percentiles are then the streaming (P2) estimates
+			- rtol: if not None, the MC stops early once the 95% confidence interval of each percentile of each method is narrower
+				than rtol x the 5-95 spread of the method, for "patience" consecutive checks (one check per chunk), after at least
+				min_iter iterations; the intervals are estimated from the chunks as batches (batch means, see StreamingStats)
+			- min_iter, patience: see rtol
 		[caution]:
-			- self.foreground_MC_LCA_results is pickled as "saved MC results.pickle"
+			- self.foreground_MC_LCA_results is pickled as "saved MC results.pickle" (the MC statistics, if keep_results is False)
+			- for large n_iter x number of methods, use keep_results=False (and rtol) to keep the memory constant
+		[note]:
+			- the db is NOT modified: the sampled exchanges are located in the technosphere matrix once, and each iteration
+			  patches those entries in memory (low-rank update of the factorized system, see TechnospherePerturbation)
+			- self.LCA_results_dict holds the results of the last iteration, self.top_processes_dict those of the deterministic LCA
+			- the number of iterations done is self.n_iter_done (< n_iter if stopped early), their mean/std are self.MC_mean/self.MC_std
+			- with n_workers > 1, each worker factorizes the technosphere once and scores chunks of iterations; the results are
+			  the same (bit-identical) for any n_workers, the samples are drawn beforehand (see parse_uncertainty, seed)
 		=====================================================================================
 		"""
 		# check if a dterministric LCA has been performed
 		assert self.calc_done==True,"Please perform a deterministic LCA using '.calc_lca' method first!"
+
+		# make sure the LCA session is up to date (only a back-substitution if so)
+		self.calc_lca(self.lcia_methods,self.foreground_db,self.FU_activity_code,self.amount_FU)
 		
 		# initiate results dict: {iter_1: {lcia1:result,lcia2:result,...}, iter_2:{lcia1:result,lcia2:result,...}...}
 		self.foreground_MC_LCA_results = {}
@@ -373,32 +525,68 @@ class LCA_MOD:
 		widgets = ["Conducting uncertainty analysis: ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
 		pbar = progressbar.ProgressBar(maxval=self.n_iter,widgets=widgets).start()
 
-		# perform MC for linked samples
-		for iter_ in range(self.n_iter):
-			# update the exchanges of the activity of interest
-			for k,v in linked_rand_samples.items():
-				for exc in self.act_uncertain.technosphere(): #self.act_uncertain from '.parse_uncertainty'
-					if exc['name']==k:
-						exc['amount']=v[iter_]
-						exc.save()
-			# do LCA
-			self.calc_lca(self.lcia_methods,self.foreground_db)
-			self.foreground_MC_LCA_results[iter_] = self.LCA_results_dict
-
-			# add lca results of this iteration to the corresponding pooled list (for statisitcal analysis later)
-			for k,v in self.LCA_results_dict.items():
-				self.pooled_results[k].append(v)
+		# locate the sampled exchanges of the activity of interest in the technosphere matrix of the LCA session (once)
+		position_deltas = {} # {(row, col) of a perturbed entry: its change for each iteration}
+		for k,v in linked_rand_samples.items():
+			for exc in self.act_uncertain.technosphere(): #self.act_uncertain from '.parse_uncertainty'
+				if (exc.input.key==k if isinstance(k, tuple) else exc['name']==k):
+					position = self.lca_session.technosphere_position(exc.input, self.act_uncertain)
+					position_deltas.setdefault(position, np.zeros(self.n_iter))
+					position_deltas[position] -= np.asarray(v[:self.n_iter]) - exc['amount'] # technosphere inputs are negative in the matrix
+		positions = list(position_deltas.keys())
+		deltas = np.column_stack([position_deltas[position] for position in positions]) if positions else np.zeros((self.n_iter, 0))
+
+		# perform MC for linked samples (do LCA with the sampled exchanges of each iteration), chunk by chunk in the order of the iterations
+		if n_workers > 1:
+			MC_chunks = iter_perturbation_scores_parallel(self.project_name, self.lca_session.demand, self.lcia_methods, positions, deltas,
+															n_workers, chunk_size)
+		else:
+			perturbation = TechnospherePerturbation(self.lca_session, positions, self.lcia_methods)
+			MC_chunks = ((start, np.vstack([perturbation.scores(deltas_iter) for deltas_iter in deltas[start:start + chunk_size]]))
+							for start in range(0, self.n_iter, chunk_size))
+
+		# mean, std and percentiles (constant memory)
+		# [note] the streaming percentiles are only needed without the kept results or for the convergence checks
+		self.MC_stats = StreamingStats(self.lcia_methods, percentiles=[5,25,50,75,95], track_percentiles=(not keep_results or rtol is not None))
+		self.n_iter_done = 0
+		self.MC_converged = False
+		for start, chunk_scores in MC_chunks:
+			for iter_, scores in enumerate(chunk_scores, start):
+				self.MC_stats.update(scores)
+				self.LCA_results_dict = dict(zip(self.lcia_methods, scores.tolist()))
+				if keep_results:
+					self.foreground_MC_LCA_results[iter_] = self.LCA_results_dict
+
+					# add lca results of this iteration to the corresponding pooled list (for statisitcal analysis later)
+					for k,v in self.LCA_results_dict.items():
+						self.pooled_results[k].append(v)
 
 			# update the progress bar
-			pbar.update(iter_)
+			self.n_iter_done = start + chunk_scores.shape[0]
+			pbar.update(self.n_iter_done)
+
+			# stop early if the confidence intervals of the percentiles are narrow enough (the chunk is a batch of the batch means)
+			if rtol is not None and self.MC_stats.check_convergence(rtol, min_iter, patience):
+				self.MC_converged = True
+				print(f"the MC results converged after {self.n_iter_done} iterations")
+				break
+		if hasattr(MC_chunks, 'close'):
+			MC_chunks.close() # cancel the chunks not started, if any
 
 		# finish progressbar
 		pbar.finish()
 
-		# obtain descriptive statistics
+		# obtain descriptive statistics (exact percentiles if the results are kept, otherwise the streaming estimates)
 		self.percentiles = {}
-		for k,v in self.pooled_results.items():
-			self.percentiles[k] = [np.percentile(v, perc) for perc in [5,25,50,75,95]]
+		if keep_results:
+			for k,v in self.pooled_results.items():
+				self.percentiles[k] = [np.percentile(v, perc) for perc in [5,25,50,75,95]]
+		else:
+			for k,v in zip(self.lcia_methods, self.MC_stats.percentile_values()):
+				self.percentiles[k] = v.tolist()
+		self.MC_mean = dict(zip(self.lcia_methods, self.MC_stats.mean.tolist()))
+		self.MC_std = dict(zip(self.lcia_methods, self.MC_stats.std().tolist()))
+		self.logger.info(f"=== {self.n_iter_done} MC iterations done (converged: {self.MC_converged}) ===")
 		
 		# log the percentiles
 		self.logger.info("=== Percentiles of MC results by impact category ===")
@@ -406,10 +594,14 @@ class LCA_MOD:
 		self.logger.info(" ")
 		print(f"the percentiles of the MC results are: {self.percentiles}")
 
-		# pickle the MC results
+		# pickle the MC results (or their statistics)
 		saved_MC_path = os.path.sep.join([config.OUTPUT_PATH,'saved MC results.pickle'])
 		with open(saved_MC_path, 'wb') as f:
-			pickle.dump(self.foreground_MC_LCA_results, f, protocol=pickle.HIGHEST_PROTOCOL)
+			if keep_results:
+				pickle.dump(self.foreground_MC_LCA_results, f, protocol=pickle.HIGHEST_PROTOCOL)
+			else:
+				pickle.dump({'n_iter_done': self.n_iter_done, 'mean': self.MC_mean, 'std': self.MC_std, 'percentiles': self.percentiles}, 
+							f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 	def export_LCA_results(self, lca_results_dict: Dict, scenario_name='undefined_scenario', unique_name=True):
@@ -58,26 +58,27 @@ try lca_mod
 ===========
 """
 
-# initiate the importer object
-lca_obj = LCA_MOD(project_name)
+# [caution] the imports may start worker processes, which import this script again (on Windows/macOS)
+# 			-> the code below only runs in the main process
+if __name__ == '__main__':
+	# initiate the importer object
+	lca_obj = LCA_MOD(project_name)
 
-# import ei bkgr db first
-lca_obj.import_bkgr_db(ei_bkgr_db_path_name_dict, bkgr_db_match_dict)
+	# import bkgr db (ei first, then the other bkgr db matched against it, built in parallel worker processes)
+	lca_obj.import_bkgr_db({**ei_bkgr_db_path_name_dict, **other_bkgr_db_path_name_dict}, bkgr_db_match_dict, 
+							n_workers=max(os.cpu_count() - 1, 1), n_concurrent=2)
 
-# import other bkgr db
-lca_obj.import_bkgr_db(other_bkgr_db_path_name_dict, bkgr_db_match_dict)
+	# import foreground db
+	lca_obj.import_foreground_db(foreground_db_path_name_dict, foreground_db_match_dict)
 
-# import foreground db
-lca_obj.import_foreground_db(foreground_db_path_name_dict, foreground_db_match_dict)
+	print(f"currently, the following db are imported: {lca_obj.db_mgmt_obj.imported_db_lst}","\n")
 
-print(f"currently, the following db are imported: {lca_obj.db_mgmt_obj.imported_db_lst}","\n")
+	# export imported db
+	lca_obj.db_mgmt_obj.export_lci_to_excel('trial_HTL')
+	lca_obj.db_mgmt_obj.export_lci_to_excel('Elegancy')
+	lca_obj.db_mgmt_obj.export_lci_to_excel('H2_from_wood_gasify_ei35_cutoff')
 
-# export imported db
-lca_obj.db_mgmt_obj.export_lci_to_excel('trial_HTL')
-lca_obj.db_mgmt_obj.export_lci_to_excel('Elegancy')
-lca_obj.db_mgmt_obj.export_lci_to_excel('H2_from_wood_gasify_ei35_cutoff')
-
-# remove an imported db
-#db_mgmt_obj.remove_db('H2_from_wood_gasify_ei35_cutoff')
-#db_mgmt_obj.imported_db_lst = list(bw.databases)
-#print(f"after removal, the existing db are: {db_mgmt_obj.imported_db_lst}")
\ No newline at end of file
+	# remove an imported db
+	#db_mgmt_obj.remove_db('H2_from_wood_gasify_ei35_cutoff')
+	#db_mgmt_obj.imported_db_lst = list(bw.databases)
+	#print(f"after removal, the existing db are: {db_mgmt_obj.imported_db_lst}")
\ No newline at end of file
@@ -7,7 +7,7 @@ Developed based on:
 	- https://doi.org/10.1039/D0SE01637C
 
 [CAUTIONS]
-	- use xlrd==1.2.0, v.2.0 and later do not support .xlsx file
+	- .xlsx templates are read with openpyxl (read-only mode), xlrd is only needed for .xls templates
 """
 
 """
@@ -18,21 +18,25 @@ Import libraries
 import brightway2 as bw
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from bw2io.importers.base_lci import LCIImporter
+from bw2io.extractors import Ecospold2DataExtractor
 from bw2io.strategies import add_database_name, csv_restore_tuples
+from bw2io.strategies.generic import format_nonunique_key_error
+from bw2io.errors import StrategyError
+from bw2io.utils import activity_hash
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-import logging
+from itertools import repeat
+import threading
+import time
 from copy import deepcopy
 import os
 import json
 from config import db_mgmt_config as config
+from utilities.log_helper import get_logger
 from typing import List, Dict, Tuple
-
-import xlrd
-from xlrd import open_workbook
-# workaround for the 'AttributeError: 'ElementTree' object has no attribute 'getiterator'': https://stackoverflow.com/questions/64264563/attributeerror-elementtree-object-has-no-attribute-getiterator-when-trying
-xlrd.xlsx.ensure_elementtree_imported(False, None)
-xlrd.xlsx.Element_has_iter = True
+import openpyxl
 
 
 class SeqImporter:
@@ -51,20 +55,9 @@ class SeqImporter:
 		set up the logger
 		=================
 		"""
-		# gets or creates a logger
-		self.logger = logging.getLogger(__name__)  
-
-		# set log level
-		self.logger.setLevel(logging.INFO)
-
-		# define file handler and set formatter
+		# gets or creates a logger (see utilities/log_helper.py)
 		log_output_path = os.path.sep.join([config.LOG_OUTPUT_PATH,'log_seq_import.log'])
-		file_handler = logging.FileHandler(log_output_path)
-		formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
-		file_handler.setFormatter(formatter)
-
-		# add file handler to logger
-		self.logger.addHandler(file_handler)  
+		self.logger = get_logger(f"{__name__}.SeqImporter", log_output_path)
 
 
 		"""
@@ -133,7 +126,7 @@ class SeqImporter:
 						if  db_to_match_name == 'self':
 							import_obj.match_database(fields=fields_to_match) #link with processes in other tabs, if any
 						else:
-							import_obj.match_database(db_to_match_name,fields=fields_to_match) #match processes in other db
+							link_index_cache.match_database(import_obj, db_to_match_name, fields=fields_to_match) #match processes in other db (cached index)
 				elif option_label.lower() == "multicolumn":
 					# use the helper function to handle multiple columns (e.g., multiple amounts for the same LCI row)
 					import_obj = MultiColImporter(db_path, db_name, config.MULTICOL_START, config.EXC_ROW_START, 
@@ -160,6 +153,9 @@ class SeqImporter:
 				# remove the db from bw.databases
 				self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db first
 				self.db_mgmt_obj.remove_db(db_name)
+			finally:
+				# the db has been written (or removed) -> its cached link indices, if any, are stale
+				link_index_cache.invalidate(db_name)
 
 		
 
@@ -198,7 +194,7 @@ class SeqImporter:
 				if db_to_match_name=='self':
 					import_foreground_obj.match_database(fields=fields_to_match) #link within the foreground processes
 				else:
-					import_foreground_obj.match_database(db_to_match_name,fields=fields_to_match) #match processes in other db
+					link_index_cache.match_database(import_foreground_obj, db_to_match_name, fields=fields_to_match) #match processes in other db (cached index)
 			import_foreground_obj.statistics()
 
 			try:
@@ -219,6 +215,9 @@ class SeqImporter:
 				# remove the db from bw.databases
 				self.db_mgmt_obj.imported_db_lst = list(databases) # update the list of db first
 				self.db_mgmt_obj.remove_db(db_name)
+			finally:
+				# the db has been written (or removed) -> its cached link indices, if any, are stale
+				link_index_cache.invalidate(foreground_db_name)
 
 		# log all the db loaded
 		self.logger.info("=== DATABASE IMPORTED ===")
@@ -229,59 +228,235 @@ class SeqImporter:
 		self.foreground_db=Database(foreground_db_name)
 
 
+class ParallelEcospold2Extractor(Ecospold2DataExtractor):
+	"""
+	extracts EcoSpold2 datasets with a configurable number of worker processes
+		- pass an instance as the 'extractor' of SingleOutputEcospold2Importer, e.g.,
+		  SingleOutputEcospold2Importer(db_path, db_name, extractor=ParallelEcospold2Extractor(n_workers=8))
+		- bw2io's own 'use_mp=True' always uses all the cores of the machine
+	"""
+
+	def __init__(self, n_workers: int, chunksize=50):
+		self.n_workers = n_workers
+		self.chunksize = chunksize # number of datasets sent to a worker at a time
+
+
+	def extract(self, dirpath, db_name, use_mp=True):
+		assert os.path.exists(dirpath), f"{dirpath} does not exist"
+		if os.path.isdir(dirpath):
+			filelist = [filename for filename in os.listdir(dirpath)
+						if os.path.isfile(os.path.join(dirpath, filename)) and filename.split(".")[-1].lower() == "spold"]
+		else:
+			dirpath, filelist = os.path.dirname(dirpath), [os.path.basename(dirpath)]
+
+		print(f"Extracting XML data from {len(filelist)} datasets with {self.n_workers} worker(s)")
+		if use_mp and self.n_workers > 1:
+			with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+				data = list(pool.map(Ecospold2DataExtractor.extract_activity, repeat(dirpath), filelist, repeat(db_name),
+									chunksize=self.chunksize))
+		else:
+			data = [Ecospold2DataExtractor.extract_activity(dirpath, filename, db_name) for filename in filelist]
+
+		return data
+
+
+def link_iterable_by_index(unlinked, candidates: Dict, duplicates: Dict, fields=None, kind=None, relink=False):
+	"""
+	links the exchanges of unlinked with a prebuilt index, same as bw2io's link_iterable_by_fields (which rebuilds the index at each call)
+	Params:
+		- candidates: {activity_hash: (db, code)} of the db to match
+		- duplicates: {activity_hash: [datasets]} of the hashes shared by more than one dataset of the db to match
+	"""
+	if kind:
+		kind = {kind} if isinstance(kind, str) else kind
+		if relink:
+			filter_func = lambda x: x.get("type") in kind
+		else:
+			filter_func = lambda x: x.get("type") in kind and not x.get("input")
+	else:
+		if relink:
+			filter_func = lambda x: True
+		else:
+			filter_func = lambda x: not x.get("input")
+
+	for container in unlinked:
+		for obj in filter(filter_func, container.get("exchanges", [])):
+			key = activity_hash(obj, fields)
+			if key in duplicates:
+				raise StrategyError(format_nonunique_key_error(obj, fields, duplicates[key]))
+			elif key in candidates:
+				obj["input"] = candidates[key]
+	return unlinked
+
+
+class LinkIndexCache:
+	"""
+	shares the indices used to link exchanges to other databases among importers, instead of rescanning the db to match (e.g., ecoinvent)
+	at each call of match_database
+		- one index per (db to match, fields to match), built at first use
+		- each index is stamped with databases[db]['modified'] -> it is rebuilt once the db is rewritten
+	Methods of this class:
+		- match_database: same as importer.match_database(db_name, fields=...), with the cached index
+		- invalidate: drops the indices of a db (e.g., after it is written or removed)
+	[note] link_index_cache (below) is the instance shared by the importers of a session; it is not shared with worker processes,
+		   so the db built in workers are linked to the other db in the main process (see link_to_other_db)
+	"""
+
+	def __init__(self):
+		self._indices = {} # {(db_name, fields): (stamp, candidates, duplicates)}
+		self._lock = threading.Lock() # the instance is module-level, keep it safe to use from several threads
+
+
+	def get_index(self, db_name: str, fields=None) -> Tuple[Dict, Dict]:
+		if db_name not in bw.databases:
+			raise StrategyError(f"Can't find external database {db_name}")
+		index_key = (db_name, tuple(fields) if fields else None)
+		stamp = bw.databases[db_name].get('modified')
+
+		with self._lock:
+			if index_key not in self._indices or self._indices[index_key][0] != stamp:
+				candidates, duplicates = {}, {}
+				try:
+					for ds in bw.Database(db_name):
+						key = activity_hash(ds, fields)
+						if key in candidates:
+							duplicates.setdefault(key, []).append(ds)
+						else:
+							candidates[key] = (ds["database"], ds["code"])
+				except KeyError:
+					raise StrategyError("Not all datasets in database to be linked have ``database`` or ``code`` attributes")
+				self._indices[index_key] = (stamp, candidates, duplicates)
+
+			return self._indices[index_key][1:]
+
+
+	def match_database(self, importer, db_name: str, fields=None, kind=None, relink=False):
+		candidates, duplicates = self.get_index(db_name, fields)
+		importer.apply_strategy(partial(link_iterable_by_index, candidates=candidates, duplicates=duplicates, 
+										fields=fields, kind=kind, relink=relink))
+
+
+	def invalidate(self, db_name: str):
+		with self._lock:
+			for index_key in [index_key for index_key in self._indices if index_key[0] == db_name]:
+				del self._indices[index_key]
+
+
+link_index_cache = LinkIndexCache()
+
+
+def read_sheet_values(wb_path: str, sheet_name: str) -> List[List]:
+	"""
+	reads all the values of a worksheet at once, returns a list of rows (all padded to the same length)
+		- .xlsx/.xlsm: streamed with openpyxl in read-only mode
+		- .xls: read with xlrd
+		- empty cells are returned as '' and the trailing empty rows and columns are dropped (e.g., blank but formatted cells,
+		  which openpyxl returns as None)
+	"""
+	if os.path.splitext(wb_path)[1].lower() == '.xls':
+		import xlrd # only needed for the legacy format
+		ws = xlrd.open_workbook(wb_path, on_demand=True).sheet_by_name(sheet_name)
+		rows = [ws.row_values(row) for row in range(ws.nrows)]
+	else:
+		wb = openpyxl.load_workbook(wb_path, read_only=True, data_only=True)
+		try:
+			rows = [['' if value is None else value for value in row] for row in wb[sheet_name].iter_rows(values_only=True)]
+		finally:
+			wb.close()
+
+	while rows and all(value == '' for value in rows[-1]):
+		rows.pop()
+	# the number of columns is the last non-empty column of any row
+	n_cols = max((max((col + 1 for col, value in enumerate(row) if value != ''), default=0) for row in rows), default=0)
+
+	return [list(row[:n_cols]) + [''] * (n_cols - len(row)) for row in rows]
+
+
 class MultiColImporter:
 	"""
 	creates an importer object to handle multiple columns (e.g., multiple entries of amount for each row of LCI) in a spreadsheet of invenotry table
+	[note]:
+		- the metadata of each exchange row is parsed once and shared by all the columns (exchange_metadata)
+		- the amounts are kept in a sparse (exchange rows x columns) matrix: the zero or blank amounts (i.e., exc not part of
+		  the process) are dropped, and the exchange dicts of a process are only created by create_process
 	"""
 
-	def __init__(self, wb_path, db_name: str, multicol_start: int, exc_row_start: int, default_proc_attr_dict: Dict):
+	def __init__(self, wb_path, db_name: str, multicol_start: int, exc_row_start: int, default_proc_attr_dict: Dict, log_exchanges=None):
+		"""
+		Params:
+			- log_exchanges: if True, every exchange of every process created is logged (verbose and slow for large sheets);
+			  defaults to config.LOG_EXCHANGES if defined in the config file, otherwise False
+		"""
 		# store attributes
 		self.db_name = db_name
+		self.log_exchanges = getattr(config, 'LOG_EXCHANGES', False) if log_exchanges is None else log_exchanges
 		self.exc_row_start = exc_row_start
 		self.default_proc_attr_dict = default_proc_attr_dict
 		self.multicol_start = multicol_start
 
-		# load the worksheet of interest
+		# load the values of the worksheet of interest at once
 		try:
-			self.ws = open_workbook(wb_path).sheet_by_name("db_to_import")
-		except KeyError: # if no such sheet, raise the exception
+			self.sheet_values = read_sheet_values(wb_path, "db_to_import")
+		except Exception: # if no such sheet (KeyError for .xlsx, XLRDError for .xls), raise the exception
 			print("[ERROR] please make sure the 'db_to_import' sheet is included in the workbook")
+			raise
+		self.n_cols = len(self.sheet_values[0]) if self.sheet_values else 0
 
 		# collect exchange metadata labels
-		self.exchange_metadata_labels = [self.ws.cell(1, y).value for y in range(self.multicol_start)] 
+		self.exchange_metadata_labels = self.sheet_values[1][:self.multicol_start]
+
+		# parse the metadata of the exchanges once, they are the same for all the processes (columns)
+		exchange_rows = self.sheet_values[self.exc_row_start:]
+		self.exchange_metadata = [dict(zip(self.exchange_metadata_labels, row[:self.multicol_start])) for row in exchange_rows]
+
+		# keep the non-zero amounts only, the name row is all that is needed from the rest of the sheet
+		self.exchange_amounts = self.parse_amounts(exchange_rows)
+		self.proc_names = self.sheet_values[0]
+		del self.sheet_values
 
 		# initiate an importer and configure importor strategies
 		self.importer = LCIImporter(self.db_name)
 		self.importer.strategies.append(partial(add_database_name, name=self.db_name))
 
-		# gets or creates a logger
-		self.logger = logging.getLogger(__name__)  
-
-		# set log level
-		self.logger.setLevel(logging.INFO)
-
-		# define file handler and set formatter
+		# gets or creates a logger (see utilities/log_helper.py)
 		log_output_path = os.path.sep.join([config.LOG_OUTPUT_PATH,'Multiple-column importing.log'])
-		file_handler = logging.FileHandler(log_output_path)
-		formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
-		file_handler.setFormatter(formatter)
-
-		# add file handler to logger
-		self.logger.addHandler(file_handler) 
+		self.logger = get_logger(f"{__name__}.MultiColImporter", log_output_path)
 
 		# get the list of locations from geodata.json (downloaded from bw2io.data.lci, see bw2io github repo)
 		with open(os.path.sep.join([config.BASE_PATH,'geodata.json']),'r') as f:
 			self.loc_lst = json.load(f)['names']
 
 
-	def get_exchanges(self, amt_column: int):
-		# initiate list of exchanges
-		exchanges = []
+	def parse_amounts(self, exchange_rows: List[List]) -> sparse.csc_matrix:
+		"""
+		returns the amounts of the process columns as a sparse (exchange rows x columns) matrix, blank cells are zero
+		"""
+		row_idx, col_idx, amounts = [], [], []
+		for row, values in enumerate(exchange_rows):
+			for col in range(self.multicol_start, self.n_cols):
+				value = values[col]
+				if value == '' or value is None:
+					continue
+				try:
+					value = float(value)
+				except (TypeError, ValueError):
+					raise ValueError(f"non-numeric amount {value!r} in row {row + self.exc_row_start + 1}, column {col + 1} of the 'db_to_import' sheet")
+				if value != 0:
+					row_idx.append(row)
+					col_idx.append(col)
+					amounts.append(value)
+
+		return sparse.csc_matrix((amounts, (row_idx, col_idx)), shape=(len(exchange_rows), self.n_cols))
 
-		for row in range(self.exc_row_start, self.ws.nrows):
-			data = dict(zip(self.exchange_metadata_labels, [self.ws.cell(row, col).value for col in range(len(self.exchange_metadata_labels))]))
-			data['amount'] = self.ws.cell(row, amt_column).value #don't forget to put zero for the row where exc is not part of the process
-			exchanges.append(data)
+
+	def get_exchanges(self, amt_column: int):
+		# combine the shared metadata of each exchange with its amount in the column of interest
+		# [note] the rows with zero amount (i.e., exc not part of the process) are skipped
+		start, end = self.exchange_amounts.indptr[amt_column], self.exchange_amounts.indptr[amt_column + 1]
+		exchanges = [
+			{**self.exchange_metadata[row], 'amount': amount}
+			for row, amount in zip(self.exchange_amounts.indices[start:end], self.exchange_amounts.data[start:end].tolist())
+			]
 
 		return exchanges
 
@@ -294,7 +469,7 @@ class MultiColImporter:
 		"""
 
 		# get process name and exchanges
-		_name = self.ws.cell(0, proc_name_column).value # [caution] hardcode: first row in the worksheet has to be reserved for proc names
+		_name = self.proc_names[proc_name_column] # [caution] hardcode: first row in the worksheet has to be reserved for proc names
 		_code = _name
 		_exchanges = self.get_exchanges(proc_name_column)
 
@@ -316,24 +491,26 @@ class MultiColImporter:
 
 		proc_created = {**self.default_proc_attr_dict, **tmp_dict}
 
-		# log the process and its exchanges
-		self.logger.info(f"==== RECORDING EXCHANGE FOR {proc_created['name']} ====")
-		for exc_dict in proc_created['exchanges']:
-			self.logger.info(exc_dict)
-		self.logger.info(" ")
+		# log the process and (if log_exchanges) its exchanges
+		self.logger.info(f"==== RECORDING {len(proc_created['exchanges'])} EXCHANGES FOR {proc_created['name']} ====")
+		if self.log_exchanges:
+			for exc_dict in proc_created['exchanges']:
+				self.logger.info(exc_dict)
+			self.logger.info(" ")
 
 		return proc_created
 
 
-	def buildNimport_db(self, db_match_dict: Dict):
+	def buildNimport_db(self, db_match_dict: Dict, link_index_cache=link_index_cache):
 		"""
 		builds the database by looping over the columns of interest (e.g., 10 different 'amt' for each exchange)
 		Arguments:
 			- db_match_dict: a dict storing the database name and fields to match, {db_name:('field_1','field_2',...)} 
 			 [Caution] the exchanges to be imported HAVE TO be from other db, not from this particular db being built
+			- link_index_cache: the LinkIndexCache used to match the other db
 		"""
 
-		self.importer.data = [self.create_process(column) for column in range(self.multicol_start, self.ws.ncols)]
+		self.importer.data = [self.create_process(column) for column in range(self.multicol_start, self.n_cols)]
 
 		# apply strategies and match db
 		self.importer.apply_strategies()
@@ -342,7 +519,7 @@ class MultiColImporter:
 				self.importer.match_database(fields=fields_to_match) #link within the foreground processes
 				print("SELF MATCHING DONE")
 			else:
-				self.importer.match_database(db_to_match_name,fields=fields_to_match) #match processes in other db
+				link_index_cache.match_database(self.importer, db_to_match_name, fields=fields_to_match) #match processes in other db
 		
 		return self.importer
 
@@ -353,3 +530,82 @@ class MultiColImporter:
 
 
 
+
+
+def build_bkgr_importer(db_name: str, db_path: str, db_format: str, option_label, db_match_dict: Dict, n_workers=1,
+						link_other_db=True) -> Tuple[LCIImporter, Dict]:
+	"""
+	parses a background db, applies the strategies and links it to the other db (i.e., everything but writing it)
+	Params:
+		- db_name, db_path, db_format, option_label: see LCA_MOD.import_bkgr_db, {db_name: (db_path, db_format, option_label)}
+		- db_match_dict: a dict storing the database name and fields to match, {db_name:('field_1','field_2',...)}
+		- n_workers: number of worker processes to parse EcoSpold2 datasets with (1: no multiprocessing)
+		- link_other_db: if False, the importer is only linked to itself ('self' of db_match_dict), link it to the other db with
+		  link_to_other_db before writing it
+	Returns:
+		- the importer, to be written (write_database) by the caller
+		- the time spent in each stage of the import, in seconds
+	"""
+	stage_timings = {}
+	stage_start = time.perf_counter()
+	if db_format.lower() == 'ecospold2':
+		import_obj = bw.SingleOutputEcospold2Importer(db_path, db_name, extractor=ParallelEcospold2Extractor(n_workers))
+		stage_timings['parsing'] = time.perf_counter() - stage_start
+		stage_start = time.perf_counter()
+		import_obj.apply_strategies()
+		stage_timings['apply_strategies'] = time.perf_counter() - stage_start
+	elif db_format.lower() == 'bw2 template':
+		if option_label == None:
+			import_obj = bw.ExcelImporter(db_path)
+			stage_timings['parsing'] = time.perf_counter() - stage_start
+			stage_start = time.perf_counter()
+			import_obj.apply_strategies()
+			stage_timings['apply_strategies'] = time.perf_counter() - stage_start
+			stage_start = time.perf_counter()
+			# need to match database
+			for db_to_match_name,fields_to_match in db_match_dict.items():
+				if  db_to_match_name == 'self':
+					import_obj.match_database(fields=fields_to_match) #link with processes in other tabs, if any
+				elif link_other_db:
+					link_index_cache.match_database(import_obj, db_to_match_name, fields=fields_to_match) #match processes in other db
+			stage_timings['linking'] = time.perf_counter() - stage_start
+		elif option_label.lower() == "multicolumn":
+			# use the helper function to handle multiple columns (e.g., multiple amounts for the same LCI row)
+			import_obj = MultiColImporter(db_path, db_name, config.MULTICOL_START, config.EXC_ROW_START, config.DEFAULT_PROC_ATTR_DICT)
+			import_obj = import_obj.buildNimport_db(db_match_dict if link_other_db else
+													{db_to_match_name: fields_to_match for db_to_match_name, fields_to_match
+													 in db_match_dict.items() if db_to_match_name == 'self'}, link_index_cache)
+			stage_timings['parsing, apply_strategies and linking'] = time.perf_counter() - stage_start
+		else:
+			raise ValueError(f"unknown option label '{option_label}' of DATABASE {db_name}")
+	else:
+		raise ValueError(f"unknown format '{db_format}' of DATABASE {db_name}")
+
+	return import_obj, stage_timings
+
+
+def link_to_other_db(import_obj, db_match_dict: Dict, link_index_cache=link_index_cache) -> float:
+	"""
+	links an importer to the other db of db_match_dict (i.e., all but 'self') with the cached indices, returns the time spent
+	"""
+	stage_start = time.perf_counter()
+	for db_to_match_name,fields_to_match in db_match_dict.items():
+		if db_to_match_name != 'self':
+			link_index_cache.match_database(import_obj, db_to_match_name, fields=fields_to_match) #match processes in other db
+	return time.perf_counter() - stage_start
+
+
+def build_bkgr_importer_in_worker(project_name: str, *args) -> Tuple[LCIImporter, Dict]:
+	"""
+	same as build_bkgr_importer(*args, link_other_db=False), in a worker process of LCA_MOD.import_bkgr_db
+		- the importer is NOT linked to the other db, the caller links it with link_to_other_db -> the indices of the other db
+		  (e.g., ecoinvent) are built once, by the link_index_cache of the calling process, and not by each worker
+	[note]:
+		- the project is set read-only here, the write lock of the project stays with the process writing the db; it is set
+		  at each call, so that the db written in the meantime (e.g., a db to match against) are seen
+		- the strategies of the importer are dropped before it is returned, as they are not always picklable (e.g., lambdas)
+	"""
+	bw.projects.set_current(project_name, writable=False)
+	import_obj, stage_timings = build_bkgr_importer(*args, link_other_db=False)
+	import_obj.strategies = []
+	return import_obj, stage_timings
@@ -12,8 +12,8 @@ Import packages
 """
 import brightway2 as bw
 from bw2io.export.excel import write_lci_excel
-import logging
 from config import lohc_config as config
+from utilities.log_helper import get_logger
 import os
 
 
@@ -25,20 +25,9 @@ class DB_mgmt:
 		set up the logger
 		=================
 		"""
-		# gets or creates a logger
-		self.logger = logging.getLogger(__name__)  
-
-		# set log level
-		self.logger.setLevel(logging.INFO)
-
-		# define file handler and set formatter
+		# gets or creates a logger (see utilities/log_helper.py)
 		log_output_path = os.path.sep.join([config.LOG_OUTPUT_PATH,'db_mgmt.log'])
-		file_handler = logging.FileHandler(log_output_path)
-		formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
-		file_handler.setFormatter(formatter)
-
-		# add file handler to logger
-		self.logger.addHandler(file_handler)  
+		self.logger = get_logger(__name__, log_output_path)
 
 
 		"""
@@ -0,0 +1,444 @@
+"""
+This helper script contains the calculation engine used by LCA_MOD
+	- LCASession: keeps ONE LCA system of a functional unit in memory, i.e., the matrices are loaded and the technosphere
+	  is factorized once, and the LCIA methods are switched with precomputed characterization vectors
+		* the processed matrices and the column ordering of the factorization are cached on disk (see load_lci_data_cached),
+		  so later sessions and worker processes of the same databases load them instead of rebuilding them
+	- TopProcesses: top processes of each LCIA method, calculated on first access
+	- TechnospherePerturbation: scores of the functional unit for perturbed technosphere entries (e.g., MC of foreground exchanges),
+	  with low-rank updates of the factorized system instead of rebuilding it
+	- iter_perturbation_scores_parallel: splits the perturbations (e.g., MC iterations) into chunks scored by a process pool, each
+	  worker factorizes the technosphere once, and yields the chunks in order (e.g., to stop once the MC results converged)
+
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import brightway2 as bw
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import glob
+import hashlib
+import itertools
+import os
+import pickle
+import shutil
+import uuid
+from typing import Dict, List, Tuple
+
+
+# attributes of a bw2calc LCA object set by LCA.load_lci_data, cached on disk by load_lci_data_cached
+_LCI_MATRICES = ('technosphere_matrix', 'biosphere_matrix')
+_LCI_ARRAYS = ('tech_params', 'bio_params')
+_LCI_DICTS = ('activity_dict', 'product_dict', 'biosphere_dict', '_activity_dict', '_product_dict', '_biosphere_dict')
+
+
+def lci_cache_dir(lca, cache_root=None) -> str:
+	"""
+	returns the cache folder of the lci data of a bw2calc LCA object (created, lci data not loaded yet)
+		- the folder name is made of the hash of the processed db files the LCA object uses (i.e., the db the functional unit
+		  depends on) and the hash of the db metadata of the project -> writing, processing or removing any db (e.g.,
+		  write_database, remove_db) changes the folder, the old one is stale
+	Params:
+		- cache_root: the folder of the caches, defaults to the 'calc_cache' folder of the current brightway2 project
+	"""
+	if cache_root is None:
+		cache_root = os.path.sep.join([bw.projects.dir, 'calc_cache'])
+	db_files_hash = hashlib.sha1(repr((bw.projects.current, sorted(lca.database_filepath))).encode('utf-8')).hexdigest()[:12]
+	db_stamps = [(db_name, bw.databases[db_name].get('modified'), bw.databases[db_name].get('processed')) for db_name in sorted(bw.databases)]
+	db_stamps_hash = hashlib.sha1(repr(db_stamps).encode('utf-8')).hexdigest()[:12]
+	return os.path.sep.join([cache_root, f"lca_session_{db_files_hash}_{db_stamps_hash}"])
+
+
+def load_lci_data_cached(lca, cache_root=None):
+	"""
+	same as lca.load_lci_data(), but the processed matrices, params and dicts are loaded from the on-disk cache, if up-to-date
+	(otherwise, they are built by bw2calc and cached, and the stale caches of the same db are deleted)
+	Params:
+		- lca: a bw2calc LCA object, created but with the lci data not loaded yet
+		- cache_root: see lci_cache_dir
+	Returns:
+		- the column ordering of the factorization of the technosphere matrix saved with the cache, None if the cache was just
+		  built (save it with save_col_order once the matrix is factorized)
+	"""
+	cache_dir = lci_cache_dir(lca, cache_root)
+	if os.path.isdir(cache_dir):
+		for attr in _LCI_MATRICES:
+			setattr(lca, attr, sparse.load_npz(os.path.sep.join([cache_dir, f"{attr}.npz"])))
+		for attr in _LCI_ARRAYS:
+			setattr(lca, attr, np.load(os.path.sep.join([cache_dir, f"{attr}.npy"])))
+		with open(os.path.sep.join([cache_dir, 'dicts.pickle']), 'rb') as f:
+			for attr, value in zip(_LCI_DICTS, pickle.load(f)):
+				setattr(lca, attr, value)
+		lca._fixed = True # the dicts are keyed by activity keys, see LCA.fix_dictionaries
+		col_order_path = os.path.sep.join([cache_dir, 'col_order.npy'])
+		return np.load(col_order_path) if os.path.exists(col_order_path) else None
+
+	lca.load_lci_data()
+
+	# remove the stale caches of the same db (not the temporary folders of caches being saved), then save the new one
+	# [note] written to a temporary folder first and then renamed, so that other processes never load a partial cache
+	for stale_dir in glob.glob(f"{glob.escape(cache_dir.rsplit('_', 1)[0])}_*"):
+		if stale_dir != cache_dir and '.tmp_' not in os.path.basename(stale_dir):
+			shutil.rmtree(stale_dir, ignore_errors=True)
+	tmp_dir = f"{cache_dir}.tmp_{uuid.uuid4().hex}"
+	os.makedirs(tmp_dir)
+	for attr in _LCI_MATRICES:
+		sparse.save_npz(os.path.sep.join([tmp_dir, f"{attr}.npz"]), getattr(lca, attr).tocsr())
+	for attr in _LCI_ARRAYS:
+		np.save(os.path.sep.join([tmp_dir, f"{attr}.npy"]), getattr(lca, attr))
+	with open(os.path.sep.join([tmp_dir, 'dicts.pickle']), 'wb') as f:
+		pickle.dump(tuple(getattr(lca, attr) for attr in _LCI_DICTS), f, protocol=pickle.HIGHEST_PROTOCOL)
+	try:
+		os.rename(tmp_dir, cache_dir)
+	except OSError: # another process has saved the same cache in the meantime
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+	return None
+
+
+def save_col_order(lca, col_order: np.ndarray, cache_root=None):
+	"""
+	adds the column ordering of the factorization of the technosphere matrix of lca to its cache (see load_lci_data_cached)
+	"""
+	cache_dir = lci_cache_dir(lca, cache_root)
+	col_order_path = os.path.sep.join([cache_dir, 'col_order.npy'])
+	if os.path.isdir(cache_dir) and not os.path.exists(col_order_path):
+		tmp_path = f"{col_order_path}.tmp_{uuid.uuid4().hex}.npy"
+		np.save(tmp_path, col_order)
+		os.replace(tmp_path, col_order_path)
+
+
+class LCASession:
+	"""
+	loads the matrices of a functional unit once, factorizes the technosphere once (A=LU) and precomputes, for each LCIA method,
+	the characterized biosphere row cB (c: characterization factors, B: biosphere matrix), so that:
+		score(method) = cB @ supply, with technosphere_matrix @ supply = demand
+	-> after the first calculation, a new LCIA method costs a dot product and a new demand costs a back-substitution
+	Methods of this class:
+		- is_valid_for: checks if the session can be reused for a functional unit and LCIA methods
+		- redo_lci: solves the system for a (new) demand
+		- scores / score_demand: LCIA scores of the current supply / of another demand
+		- unit_scores: LCIA scores of one unit of EVERY product (one transposed solve per method)
+		- top_processes: top processes of a method, same output as bw2analyzer's ContributionAnalysis().annotated_top_processes
+	[note] self.lca is a bw2calc LCA object sharing the matrices, dicts and supply of the session (e.g., for bw2analyzer)
+	"""
+
+	def __init__(self, demand: Dict, lcia_methods: List[Tuple], cache_root=None):
+		"""
+		Params:
+			- demand: the functional unit, {activity (or activity key): amount}
+			- lcia_methods: a list of LCIA methods of interest: [(method1),(method2)...]
+			- cache_root: the folder of the on-disk caches of the matrices, see lci_cache_dir
+		"""
+		self.demand = {self.to_key(act): amount for act, amount in demand.items()}
+		self.lcia_methods = list(lcia_methods)
+
+		# load the matrices (same as LCA.lci, without solving the system), from the on-disk cache if up-to-date
+		self.lca = bw.LCA(self.demand, self.lcia_methods[0])
+		col_order = load_lci_data_cached(self.lca, cache_root)
+		self.db_stamp = self.current_db_stamp() # after the LCA object is created, as it processes the "dirty" db, if any
+		self.reverse_activity_dict = {col: key for key, col in self.lca.activity_dict.items()}
+		if col_order is None:
+			# first session of these matrices: find the column ordering and cache it, then factorize with it as any later session
+			# -> the same factorization (and bit-identical results) in all the sessions and worker processes
+			col_order = np.argsort(splu(self.lca.technosphere_matrix.tocsc()).perm_c)
+			save_col_order(self.lca, col_order, cache_root)
+		self.factorize(col_order)
+
+		# precompute the characterization vectors: c (diagonal of the characterization matrix) and cB
+		self.char_vectors, self.char_biosphere_rows = {}, {}
+		for method in self.lcia_methods:
+			self.lca.switch_method(method) # sets the method file path too, load_lcia_data alone reloads the first method
+			self.char_vectors[method] = self.lca.characterization_matrix.diagonal()
+			self.char_biosphere_rows[method] = self.lca.biosphere_matrix.T @ self.char_vectors[method]
+
+		self.redo_lci()
+
+
+	@staticmethod
+	def to_key(act) -> Tuple:
+		return act.key if hasattr(act, 'key') else tuple(act)
+
+
+	@staticmethod
+	def current_db_stamp() -> Tuple:
+		"""
+		returns a stamp of the databases of the current project, it changes when a db is written, modified or removed
+		"""
+		return tuple((db_name, bw.databases[db_name].get('modified'), bw.databases[db_name].get('dirty')) for db_name in sorted(bw.databases))
+
+
+	def is_valid_for(self, demand: Dict, lcia_methods: List[Tuple]) -> bool:
+		return (self.db_stamp == self.current_db_stamp() and set(lcia_methods) <= set(self.lcia_methods) and
+				{self.to_key(act): amount for act, amount in demand.items()} == self.demand)
+
+
+	def factorize(self, col_order=None):
+		"""
+		factorizes the technosphere matrix (A=LU)
+		Params:
+			- col_order: (optional) the column ordering of a previous factorization of the same matrix (e.g., from the cache),
+			  only the numeric factorization is redone
+		"""
+		technosphere_matrix = self.lca.technosphere_matrix.tocsc()
+		if col_order is None:
+			self.lu = splu(technosphere_matrix)
+			self.col_order = np.argsort(self.lu.perm_c) # fill-reducing column ordering found by SuperLU
+			self._sol_order = None
+		else:
+			# [note] SuperLU objects can not be pickled, so the factors themselves can not be cached
+			self.col_order = np.asarray(col_order)
+			self.lu = splu(technosphere_matrix[:, self.col_order].tocsc(), permc_spec='NATURAL')
+			self._sol_order = np.argsort(self.col_order)
+		self.lca.solver = self.solve # used by LCA.solve_linear_system, if called
+		self._unit_scores = {} # {method: unit scores}, only valid for this factorization
+
+
+	def solve(self, rhs: np.ndarray, trans='N') -> np.ndarray:
+		"""
+		solves A x = rhs (trans='N') or A^T x = rhs (trans='T') with the factorization, rhs can have one column per right-hand side
+		"""
+		if self._sol_order is None:
+			return self.lu.solve(rhs, trans=trans)
+		# the factorized matrix is A[:, col_order]
+		if trans == 'N':
+			return self.lu.solve(rhs)[self._sol_order]
+		return self.lu.solve(np.asfortranarray(rhs[self.col_order]), trans=trans)
+
+
+	def build_demand_array(self, demand: Dict) -> np.ndarray:
+		demand_array = np.zeros(len(self.lca.product_dict))
+		for act, amount in demand.items():
+			demand_array[self.lca.product_dict[self.to_key(act)]] += amount
+		return demand_array
+
+
+	def redo_lci(self, demand=None):
+		"""
+		solves the system for demand (default: the functional unit of the session)
+		"""
+		if demand is not None:
+			self.demand = {self.to_key(act): amount for act, amount in demand.items()}
+		self.lca.demand = self.demand
+		self.lca.demand_array = self.build_demand_array(self.demand)
+		self.lca.supply_array = self.solve(self.lca.demand_array)
+
+
+	def scores(self, lcia_methods=None) -> Dict:
+		"""
+		returns the LCIA scores of the current supply, {method: score}
+		"""
+		return {method: float(self.char_biosphere_rows[method] @ self.lca.supply_array) for method in (lcia_methods or self.lcia_methods)}
+
+
+	def score_demand(self, demand: Dict, method: Tuple) -> float:
+		"""
+		returns the LCIA score of another demand (e.g., an exchange of the functional unit), the session supply is untouched
+		"""
+		return float(self.char_biosphere_rows[method] @ self.solve(self.build_demand_array(demand)))
+
+
+	def unit_scores(self, method: Tuple) -> np.ndarray:
+		"""
+		returns the LCIA scores of one unit of each product (indexed by product_dict), computed with ONE transposed solve:
+			unit_scores = A^-T (cB)^T -> score of any demand d = unit_scores @ d
+		"""
+		if method not in self._unit_scores:
+			self._unit_scores[method] = self.solve(self.char_biosphere_rows[method], trans='T')
+		return self._unit_scores[method]
+
+
+	def technosphere_position(self, input_act, output_act) -> Tuple[int, int]:
+		"""
+		returns the (row, col) of the exchange from input_act to output_act in the technosphere matrix
+		"""
+		return self.lca.product_dict[self.to_key(input_act)], self.lca.activity_dict[self.to_key(output_act)]
+
+
+	def top_processes(self, method: Tuple, limit=25, supply=None) -> List[Tuple]:
+		"""
+		returns the top processes of method as a list of tuples: (lca score, supply, activity), sorted by absolute lca score
+			- the lca score of a process is the column sum of the characterized inventory, i.e., cB * supply
+			- the top "limit" processes are selected with np.argpartition (O(n)), only those are sorted
+		Params:
+			- supply: supply array to use (default: the current supply of the session)
+		"""
+		supply = self.lca.supply_array if supply is None else supply
+		contributions = self.char_biosphere_rows[method] * supply
+		limit = min(limit, len(contributions))
+		if limit <= 0:
+			return []
+
+		top = np.argpartition(-np.abs(contributions), limit - 1)[:limit]
+		top = top[np.argsort(-np.abs(contributions[top]), kind='stable')]
+
+		return [(float(contributions[col]), float(supply[col]), bw.get_activity(self.reverse_activity_dict[col])) for col in top]
+
+
+class TopProcesses(Mapping):
+	"""
+	a read-only dict of {method: top processes}, the top processes of a method are only calculated on first access (and cached)
+		- the supply of the session is copied when the object is created, i.e., later calculations do not change the results
+		- top(method, n) returns the top n processes (recalculated if n is larger than limit)
+	"""
+
+	def __init__(self, lca_session: LCASession, lcia_methods: List[Tuple], limit=25):
+		self.lca_session = lca_session
+		self.lcia_methods = list(lcia_methods)
+		self.limit = limit
+		self.supply = lca_session.lca.supply_array.copy()
+		self._top_processes = {}
+
+
+	def __getitem__(self, method: Tuple) -> List[Tuple]:
+		if method not in self.lcia_methods:
+			raise KeyError(method)
+		if method not in self._top_processes:
+			self._top_processes[method] = self.lca_session.top_processes(method, self.limit, self.supply)
+		return self._top_processes[method]
+
+
+	def __iter__(self):
+		return iter(self.lcia_methods)
+
+
+	def __len__(self) -> int:
+		return len(self.lcia_methods)
+
+
+	def top(self, method: Tuple, n: int) -> List[Tuple]:
+		if n > self.limit:
+			return self.lca_session.top_processes(method, n, self.supply)
+		return self[method][:n]
+
+
+class TechnospherePerturbation:
+	"""
+	calculates the scores of the functional unit of an LCA session for perturbed technosphere entries, WITHOUT changing the db or
+	the session: only the perturbed entries (positions) are patched, with the Woodbury identity
+		(A + P D Q^T)^-1 = A^-1 - Z D (I + Q^T Z D)^-1 Q^T A^-1, with Z = A^-1 P
+		- P (Q): the unit vectors of the rows (cols) of the perturbed entries, D: the changes of the entries (rows x cols)
+		- Z (one solve per perturbed row) and the characterized Z are computed once -> an iteration costs O(methods x entries),
+		  no matter the size of the technosphere
+		- if (I + Q^T Z D) is ill-conditioned, the perturbed technosphere is refactorized instead
+	"""
+
+	# max. condition number of (I + Q^T Z D) for the low-rank update
+	MAX_COND = 1e10
+
+	def __init__(self, lca_session: LCASession, positions: List[Tuple[int, int]], lcia_methods: List[Tuple]):
+		"""
+		Params:
+			- positions: (row, col) of the technosphere entries to perturb, see LCASession.technosphere_position
+			- lcia_methods: a list of LCIA methods of interest: [(method1),(method2)...]
+		"""
+		self.lca_session = lca_session
+		self.positions = list(positions)
+		self.lcia_methods = list(lcia_methods)
+
+		# index of the row/col of each perturbed entry in D
+		rows, cols = sorted(set(row for row, _ in self.positions)), sorted(set(col for _, col in self.positions))
+		self.rows, self.cols = np.array(rows, dtype=int), np.array(cols, dtype=int)
+		self.entry_rows = np.array([rows.index(row) for row, _ in self.positions], dtype=int)
+		self.entry_cols = np.array([cols.index(col) for _, col in self.positions], dtype=int)
+
+		# precompute Z = A^-1 P, the unperturbed supply x0 and their characterized values
+		unit_vectors = np.zeros((len(lca_session.lca.product_dict), len(rows)))
+		unit_vectors[self.rows, np.arange(len(rows))] = 1
+		self.Z = lca_session.solve(unit_vectors) if rows else unit_vectors
+		self.x0 = lca_session.solve(lca_session.build_demand_array(lca_session.demand))
+		self.char_stack = np.vstack([lca_session.char_biosphere_rows[method] for method in self.lcia_methods])
+		self.s0 = self.char_stack @ self.x0
+		self.char_Z = self.char_stack @ self.Z
+
+
+	def scores(self, deltas: np.ndarray) -> np.ndarray:
+		"""
+		returns the scores (one per LCIA method) of the FU, with the technosphere entries at positions changed by deltas
+		Params:
+			- deltas: the change of each entry of positions (in the matrix sign convention, i.e., -x for an input increased by x)
+		"""
+		if not self.positions:
+			return self.s0.copy()
+
+		D = np.zeros((len(self.rows), len(self.cols)))
+		np.add.at(D, (self.entry_rows, self.entry_cols), deltas)
+		G = np.eye(len(self.cols)) + self.Z[self.cols, :] @ D
+		if np.linalg.cond(G) > self.MAX_COND:
+			return self.refactorized_scores(deltas)
+
+		return self.s0 - self.char_Z @ (D @ np.linalg.solve(G, self.x0[self.cols]))
+
+
+	def refactorized_scores(self, deltas: np.ndarray) -> np.ndarray:
+		technosphere_matrix = self.lca_session.lca.technosphere_matrix.tolil(copy=True)
+		for (row, col), delta in zip(self.positions, deltas):
+			technosphere_matrix[row, col] += delta
+		supply = splu(technosphere_matrix.tocsc()).solve(self.lca_session.build_demand_array(self.lca_session.demand))
+
+		return self.char_stack @ supply
+
+
+# state of a worker process of iter_perturbation_scores_parallel: the perturbation object of the worker
+_WORKER_STATE = {}
+
+
+def _init_worker(project_name: str, demand: Dict, lcia_methods: List[Tuple], positions: List[Tuple[int, int]]):
+	# read-only, the workers only read the project (no write lock, see bw.projects.set_current)
+	bw.projects.set_current(project_name, writable=False)
+	# the session loads the matrices cached by the session of the parent process (see load_lci_data_cached)
+	lca_session = LCASession(demand, lcia_methods)
+	_WORKER_STATE['perturbation'] = TechnospherePerturbation(lca_session, positions, lcia_methods)
+
+
+def _score_chunk(start: int, deltas: np.ndarray) -> Tuple[int, np.ndarray]:
+	perturbation = _WORKER_STATE['perturbation']
+	return start, np.vstack([perturbation.scores(deltas_iter) for deltas_iter in deltas])
+
+
+def iter_perturbation_scores_parallel(project_name: str, demand: Dict, lcia_methods: List[Tuple], positions: List[Tuple[int, int]],
+									deltas: np.ndarray, n_workers: int, chunk_size=250):
+	"""
+	scores the perturbations of the technosphere (see TechnospherePerturbation) with a process pool, yields (start, chunk scores)
+	IN THE ORDER of the perturbations
+		- at most 2 chunks per worker are submitted ahead of the one yielded -> the caller can stop early (e.g., once the MC
+		  results converged), the chunks not started are cancelled
+	Params:
+		- project_name: the brightway2 project of the db
+		- demand: the functional unit, {activity key: amount}
+		- lcia_methods: a list of LCIA methods of interest: [(method1),(method2)...]
+		- positions: (row, col) of the technosphere entries to perturb
+		- deltas: (perturbations x positions) array, the changes of the entries for each perturbation (e.g., MC iteration)
+		- n_workers: number of worker processes
+		- chunk_size: number of perturbations sent to a worker at a time
+	Yields:
+		- (start, chunk scores): the index of the first perturbation of the chunk, and a (chunk perturbations x methods) array
+	[note]:
+		- each worker builds its own LCA session (i.e., loads the matrices and factorizes the technosphere once)
+		- the score of a perturbation is calculated by the same code with the same inputs no matter the worker/chunk it is part
+		  of -> the results do not depend on n_workers or chunk_size
+	"""
+	starts = iter(range(0, deltas.shape[0], chunk_size))
+	pending = collections.deque()
+	with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+							initargs=(project_name, demand, list(lcia_methods), list(positions))) as pool:
+		try:
+			for start in itertools.islice(starts, 2 * n_workers):
+				pending.append(pool.submit(_score_chunk, start, deltas[start:start + chunk_size]))
+			while pending:
+				start, chunk_scores = pending.popleft().result()
+				next_start = next(starts, None)
+				if next_start is not None:
+					pending.append(pool.submit(_score_chunk, next_start, deltas[next_start:next_start + chunk_size]))
+				yield start, chunk_scores
+		finally:
+			for future in pending:
+				future.cancel()
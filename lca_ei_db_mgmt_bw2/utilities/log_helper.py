@@ -0,0 +1,75 @@
+"""
+This helper script contains the logging setup shared by the importers and the LCA classes
+	- get_logger: returns a logger writing (asynchronously) to a log file
+
+[CAUTIONS]
+	- always get the loggers with get_logger, adding handlers to the loggers directly writes the messages more than once
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+
+# one queue listener (and hence one file handler) per log file: {abs log path: QueueListener}
+_LISTENERS = {}
+_LOCK = threading.Lock()
+
+
+def get_logger(name: str, log_path: str, level=logging.INFO) -> logging.Logger:
+	"""
+	gets or creates a logger writing to log_path
+	Params:
+		- name: name of the logger (e.g., __name__ of the module using it)
+		- log_path: path to the log file
+		- level: log level of the logger
+	[note]:
+		- the logger only puts the messages on a queue, the file is written by a background thread (QueueListener) ->
+		  logging does not block the calculations/imports
+		- calling get_logger again (e.g., for each instance of a class) does not add handlers, so each msg is written once
+		- the listeners are stopped (i.e., the remaining messages are written) at exit
+	"""
+	logger = logging.getLogger(name)
+	logger.setLevel(level)
+
+	with _LOCK:
+		log_path = os.path.abspath(log_path)
+		if log_path not in _LISTENERS:
+			# define file handler and set formatter
+			file_handler = logging.FileHandler(log_path)
+			file_handler.setFormatter(logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s'))
+
+			# write the messages on the queue to the file in the background
+			log_queue = queue.Queue(-1)
+			listener = logging.handlers.QueueListener(log_queue, file_handler)
+			listener.start()
+			_LISTENERS[log_path] = listener
+
+		# add the queue handler of this file to the logger, if not done already
+		log_queue = _LISTENERS[log_path].queue
+		if not any(isinstance(handler, logging.handlers.QueueHandler) and handler.queue is log_queue for handler in logger.handlers):
+			logger.addHandler(logging.handlers.QueueHandler(log_queue))
+		logger.propagate = False
+
+	return logger
+
+
+@atexit.register
+def stop_listeners():
+	"""
+	writes the remaining messages and closes the log files
+	"""
+	with _LOCK:
+		for listener in _LISTENERS.values():
+			listener.stop()
+			for handler in listener.handlers:
+				handler.close()
+		_LISTENERS.clear()
@@ -0,0 +1,210 @@
+"""
+This helper script contains the streaming statistics of the Monte Carlo simulations of LCA_MOD
+	- P2Quantile: estimates a quantile of a stream of values with constant memory (P-square algorithm)
+	- StreamingStats: mean, variance and percentiles of the MC results of each LCIA method, updated iteration by iteration,
+	  with confidence intervals of the percentiles (batch means) and a convergence check for early stopping
+
+Developed based on:
+	- Jain, R. and Chlamtac, I. (1985), the P2 algorithm for dynamic calculation of quantiles and histograms without storing
+	  observations, https://doi.org/10.1145/4372.4378
+	- Law, A.M. and Kelton, W.D., Simulation Modeling and Analysis, the method of batch means for confidence intervals
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import numpy as np
+from scipy import stats
+from typing import List, Tuple
+
+
+class P2Quantile:
+	"""
+	estimates the p-quantile (0 < p < 1) of a stream of values with 5 markers (P-square algorithm), i.e., without storing the values
+		- the estimate is exact for the first 5 values
+	"""
+
+	def __init__(self, p: float):
+		self.p = p
+		self.initial_values = [] # the first 5 values
+		self.heights = None # marker heights
+		self.positions = None # marker positions (1-based)
+		self.desired_positions = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+		self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+
+	def update(self, x: float):
+		if self.heights is None:
+			self.initial_values.append(x)
+			if len(self.initial_values) == 5:
+				self.heights = sorted(self.initial_values)
+				self.positions = [1, 2, 3, 4, 5]
+			return
+
+		q, n = self.heights, self.positions
+
+		# find the cell k of x (q[k] <= x < q[k+1]), update the extreme markers if needed
+		if x < q[0]:
+			q[0] = x
+			k = 0
+		elif x >= q[4]:
+			q[4] = x
+			k = 3
+		else:
+			k = 0
+			while x >= q[k + 1]:
+				k += 1
+
+		# increment the positions of the markers above x and the desired positions of all the markers
+		for i in range(k + 1, 5):
+			n[i] += 1
+		for i in range(5):
+			self.desired_positions[i] += self.increments[i]
+
+		# adjust the heights of the middle markers, if they are off their desired positions
+		for i in (1, 2, 3):
+			d = self.desired_positions[i] - n[i]
+			if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+				d = 1 if d > 0 else -1
+				# piecewise-parabolic (P2) prediction, linear if it is not within the neighbouring markers
+				q_new = q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+															(n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+				if not q[i - 1] < q_new < q[i + 1]:
+					q_new = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+				q[i] = q_new
+				n[i] += d
+
+
+	def value(self) -> float:
+		if self.heights is None:
+			return float(np.percentile(self.initial_values, self.p * 100)) if self.initial_values else np.nan
+		return self.heights[2]
+
+
+class StreamingStats:
+	"""
+	keeps the statistics of the MC results of each LCIA method with constant memory
+		- mean and variance: Welford's online algorithm
+		- percentiles: one P2Quantile per (method, percentile)
+		- confidence intervals of the percentiles: batch means, i.e., the iterations between two calls of close_batch (or
+		  check_convergence) form a batch, the percentiles of each batch are estimated separately (P2) and the spread of the
+		  batch estimates gives the standard error of the percentiles
+	Methods of this class:
+		- update: adds the results (one per method) of an iteration
+		- close_batch: ends the current batch of iterations
+		- percentile_ci: half-widths of the confidence intervals of the percentiles
+		- check_convergence: checks if the confidence intervals of the percentiles are narrow enough, see the docstring
+	"""
+
+	# min. number of batches for a confidence interval
+	MIN_BATCHES = 5
+
+	def __init__(self, lcia_methods: List[Tuple], percentiles=(5, 25, 50, 75, 95), track_percentiles=True):
+		"""
+		Params:
+			- lcia_methods: a list of LCIA methods of interest: [(method1),(method2)...]
+			- percentiles: the percentiles to estimate
+			- track_percentiles: if False, only the mean and variance are updated (the P2 updates are the costly part of update),
+			  the percentiles and their confidence intervals are then NaN
+		"""
+		self.lcia_methods = list(lcia_methods)
+		self.percentiles = list(percentiles)
+		self.track_percentiles = track_percentiles
+		self.n = 0
+		self.mean = np.zeros(len(self.lcia_methods))
+		self.M2 = np.zeros(len(self.lcia_methods)) # sum of squared differences to the mean
+		self.quantiles = [[P2Quantile(perc / 100) for perc in self.percentiles] for _ in self.lcia_methods]
+
+		# batch means of the percentiles: (methods x percentiles) Welford's statistics of the batch estimates
+		self.batch_quantiles = self._new_quantiles()
+		self.n_batch_iter = 0 # iterations in the current batch
+		self.n_batches = 0
+		self.batch_mean = np.zeros((len(self.lcia_methods), len(self.percentiles)))
+		self.batch_M2 = np.zeros((len(self.lcia_methods), len(self.percentiles)))
+
+		# for check_convergence
+		self.n_stable_checks = 0
+
+
+	def _new_quantiles(self) -> List[List[P2Quantile]]:
+		return [[P2Quantile(perc / 100) for perc in self.percentiles] for _ in self.lcia_methods]
+
+
+	def update(self, results: np.ndarray):
+		self.n += 1
+		delta = results - self.mean
+		self.mean += delta / self.n
+		self.M2 += delta * (results - self.mean)
+		if not self.track_percentiles:
+			return
+		for method_quantiles, method_batch_quantiles, x in zip(self.quantiles, self.batch_quantiles, results):
+			for quantile, batch_quantile in zip(method_quantiles, method_batch_quantiles):
+				quantile.update(float(x))
+				batch_quantile.update(float(x))
+		self.n_batch_iter += 1
+
+
+	def close_batch(self):
+		"""
+		adds the percentile estimates of the current batch to the batch statistics and starts a new batch
+		[note] the batches should have (about) the same number of iterations, e.g., one batch per chunk of MC iterations
+		"""
+		if self.n_batch_iter == 0:
+			return
+		estimates = np.array([[quantile.value() for quantile in method_quantiles] for method_quantiles in self.batch_quantiles])
+		self.n_batches += 1
+		delta = estimates - self.batch_mean
+		self.batch_mean += delta / self.n_batches
+		self.batch_M2 += delta * (estimates - self.batch_mean)
+		self.batch_quantiles = self._new_quantiles()
+		self.n_batch_iter = 0
+
+
+	def std(self) -> np.ndarray:
+		return np.sqrt(self.M2 / (self.n - 1)) if self.n > 1 else np.full(len(self.lcia_methods), np.nan)
+
+
+	def percentile_values(self) -> np.ndarray:
+		"""
+		returns a (methods x percentiles) array of the current estimates
+		"""
+		if not self.track_percentiles:
+			return np.full((len(self.lcia_methods), len(self.percentiles)), np.nan)
+		return np.array([[quantile.value() for quantile in method_quantiles] for method_quantiles in self.quantiles])
+
+
+	def percentile_ci(self, confidence=0.95) -> np.ndarray:
+		"""
+		returns a (methods x percentiles) array of the half-widths of the confidence intervals of the percentiles
+			- t_(1+confidence)/2, n_batches-1 x (std of the batch estimates) / sqrt(n_batches), from the closed batches
+			- NaN if there are fewer than MIN_BATCHES batches
+		"""
+		if self.n_batches < self.MIN_BATCHES:
+			return np.full((len(self.lcia_methods), len(self.percentiles)), np.nan)
+		batch_std = np.sqrt(self.batch_M2 / (self.n_batches - 1))
+		return stats.t.ppf((1 + confidence) / 2, self.n_batches - 1) * batch_std / np.sqrt(self.n_batches)
+
+
+	def check_convergence(self, rtol: float, min_iter: int, patience: int, confidence=0.95) -> bool:
+		"""
+		closes the current batch (see close_batch), then returns True once the percentiles of all the methods are precise enough:
+			- at least min_iter iterations (and MIN_BATCHES batches) are done, and
+			- for "patience" consecutive checks, the width of the confidence interval of each percentile (see percentile_ci) is
+			  at most rtol x the spread of the percentiles of the method, i.e., the distance between the lowest and highest
+			  percentiles (e.g., 5th-95th), or the absolute value of the estimates if the spread is 0
+		[note] call it at a fixed interval of iterations (e.g., after each chunk of iterations), each call ends a batch
+		"""
+		self.close_batch()
+		ci_widths = 2 * self.percentile_ci(confidence)
+		if np.isnan(ci_widths).any():
+			self.n_stable_checks = 0
+		else:
+			current = self.percentile_values()
+			scale = current.max(axis=1, keepdims=True) - current.min(axis=1, keepdims=True)
+			scale = np.where(scale > 0, scale, np.abs(current))
+			relative_widths = ci_widths / np.where(scale > 0, scale, 1)
+			self.n_stable_checks = self.n_stable_checks + 1 if np.all(relative_widths <= rtol) else 0
+
+		return self.n >= min_iter and self.n_stable_checks >= patience
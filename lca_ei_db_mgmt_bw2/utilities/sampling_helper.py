@@ -0,0 +1,60 @@
+"""
+This helper script contains the quasi-random sampling of uncertain parameters, used by LCA_MOD.parse_uncertainty
+	- quasi_random_samples: Latin hypercube or scrambled Sobol samples of stats_arrays distributions (via their inverse CDFs)
+
+"""
+
+"""
+================
+Import libraries
+================
+"""
+import numpy as np
+import stats_arrays
+from scipy.stats import qmc
+
+
+def quasi_random_samples(params: np.ndarray, n_samples: int, sampling='lhs', seed=None) -> np.ndarray:
+	"""
+	draws quasi-random samples of the uncertain parameters
+		- uniform samples on (0,1)^n_params are drawn with a Latin hypercube ('lhs') or a scrambled Sobol sequence ('sobol'),
+		  then mapped through the inverse CDF (ppf) of the stats_arrays distribution of each parameter
+		- bounded parameters (minimum/maximum): the uniform samples are rescaled to (cdf(minimum), cdf(maximum)) first
+	Params:
+		- params: a stats_arrays parameter array, e.g., from stats_arrays.UncertaintyBase.from_dicts
+		- n_samples: number of samples (for 'sobol', a power of 2 keeps the balance properties of the sequence)
+		- sampling: 'lhs' or 'sobol'
+		- seed: seed of the randomization (permutations of the hypercube / scrambling of the sequence)
+	Returns:
+		- a (n_samples x n_params) array
+	[caution] only distributions with a ppf in stats_arrays are supported (e.g., not gamma or weibull)
+	"""
+	if sampling == 'lhs':
+		sampler = qmc.LatinHypercube(d=params.shape[0], seed=np.random.default_rng(seed))
+	elif sampling == 'sobol':
+		sampler = qmc.Sobol(d=params.shape[0], scramble=True, seed=np.random.default_rng(seed))
+	else:
+		raise ValueError(f"unknown sampling '{sampling}', use 'lhs' or 'sobol'")
+	uniform = sampler.random(n_samples)
+
+	samples = np.zeros(uniform.shape)
+	for uncertainty_type in stats_arrays.uncertainty_choices:
+		mask = params['uncertainty_type'] == uncertainty_type.id
+		if not mask.any():
+			continue
+		type_params = params[mask]
+
+		# rescale the uniform samples of the bounded parameters
+		lower, upper = np.zeros(mask.sum()), np.ones(mask.sum())
+		try:
+			for bound, cum_density in (('minimum', lower), ('maximum', upper)):
+				bounded = ~np.isnan(type_params[bound])
+				if bounded.any():
+					cum_density[bounded] = uncertainty_type.cdf(type_params[bounded], type_params[bound][bounded].reshape((-1, 1))).ravel()
+			percentages = lower[:, None] + uniform[:, mask].T * (upper - lower)[:, None]
+
+			samples[:, mask] = uncertainty_type.ppf(type_params, percentages).T
+		except NotImplementedError:
+			raise ValueError(f"{uncertainty_type.description} distributions can not be sampled with '{sampling}', use sampling='random'")
+
+	return samples